@@ -3,11 +3,13 @@ class Attachment:
 
     Model that describes an attachment to an MMS message.
     """
-    album_id = None  # Google Photos ID (not used)
-    photo_id = None  # Google Photos ID (not used)
-    media_type = None  # Type of attachment: PHOTO, ANIMATED_PHOTO, VIDEO
-    original_content_url = None
-    download_url = None  # Not used, since it doesn't seem to work
+    __slots__ = (
+        "album_id",  # Google Photos ID (not used)
+        "photo_id",  # Google Photos ID (not used)
+        "media_type",  # Type of attachment: PHOTO, ANIMATED_PHOTO, VIDEO
+        "original_content_url",
+        "download_url",  # Not used, since it doesn't seem to work
+    )
 
     def __init__(self, album_id=None, photo_id=None, media_type=None, original_content_url=None, download_url=None):
         self.album_id = album_id
@@ -0,0 +1,234 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+
+INDEX_FILE_NAME = "index.json"
+OBJECTS_DIRECTORY = "objects"
+
+
+class AttachmentCache:
+    """Persistent on-disk cache of downloaded attachments.
+
+    Attachment data is stored once per SHA-256 content hash, so identical media referenced by several
+    keys (URLs, photo IDs) is only kept once. An index maps keys to content hashes. The total size of the
+    cache is bounded and the least recently used content is evicted first.
+    """
+
+    def __init__(self, directory, max_bytes=2 * 1024 * 1024 * 1024, save_interval=30):
+        """Open (or create) a cache.
+
+        :param directory: directory holding the cache
+        :param max_bytes: maximum total size of the cached content
+        :param save_interval: minimum number of seconds between automatic saves of the index
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.save_interval = save_interval
+        self._keys = {}  # key -> content hash
+        self._objects = {}  # content hash -> [size, last used]
+        self._clock = 0
+        self._total_bytes = 0
+        self._dirty = False
+        self._last_save = time.monotonic()
+        self._lock = threading.RLock()
+        os.makedirs(os.path.join(directory, OBJECTS_DIRECTORY), exist_ok=True)
+        self._load()
+
+    def get(self, *keys):
+        """Return the cached data for the first of the keys that is present.
+
+        :param keys: keys to look up, in order of preference
+        :return: cached bytes, or None if none of the keys are cached
+        """
+        path = self.path(*keys)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as data_file:
+                return data_file.read()
+        except OSError:
+            return None
+
+    def path(self, *keys):
+        """Return the path of the cached file for the first of the keys that is present.
+
+        :param keys: keys to look up, in order of preference
+        :return: file path, or None if none of the keys are cached
+        """
+        with self._lock:
+            for key in keys:
+                content_hash = self._keys.get(key)
+                if content_hash is None:
+                    continue
+                path = self._object_path(content_hash)
+                if not os.path.exists(path):
+                    self._forget(content_hash)
+                    continue
+                # Make sure every key points at the content from now on
+                for other_key in keys:
+                    if self._keys.get(other_key) != content_hash:
+                        self._keys[other_key] = content_hash
+                self._touch(content_hash)
+                return path
+        return None
+
+    def put(self, data, keys):
+        """Store data in the cache.
+
+        :param data: bytes to store
+        :param keys: keys under which the data can be looked up
+        :return: path of the cached file, or the data itself if it is larger than max_bytes
+        """
+        cache_writer = self.writer(keys)
+        cache_writer.write(data)
+        return cache_writer.commit()
+
+    def writer(self, keys):
+        """Return a writer that streams data into the cache.
+
+        The data is written to a temporary file and hashed as it arrives; calling commit() on the writer
+        stores it under the keys and returns the path of the cached file, abort() discards it. Data larger
+        than max_bytes is not stored; commit() returns the data itself instead.
+
+        :param keys: keys under which the data can be looked up
+        :return: CacheWriter
+        """
+        return CacheWriter(self, keys)
+
+    def save(self):
+        """Write the index to disk."""
+        with self._lock:
+            if not self._dirty:
+                return
+            index_path = os.path.join(self.directory, INDEX_FILE_NAME)
+            with open(index_path + ".tmp", "w") as index_file:
+                json.dump({"clock": self._clock, "keys": self._keys, "objects": self._objects}, index_file)
+            os.replace(index_path + ".tmp", index_path)
+            self._dirty = False
+            self._last_save = time.monotonic()
+
+    def _load(self):
+        # Reads the index, dropping entries whose files are gone and files that are not indexed
+        try:
+            with open(os.path.join(self.directory, INDEX_FILE_NAME)) as index_file:
+                index = json.load(index_file)
+        except (OSError, ValueError):
+            index = {}
+        self._clock = index.get("clock", 0)
+        objects_directory = os.path.join(self.directory, OBJECTS_DIRECTORY)
+        on_disk = set()
+        for prefix in os.listdir(objects_directory):
+            if not os.path.isdir(os.path.join(objects_directory, prefix)):
+                # Leftover temporary file from an interrupted download
+                os.remove(os.path.join(objects_directory, prefix))
+                continue
+            for file_name in os.listdir(os.path.join(objects_directory, prefix)):
+                if file_name in index.get("objects", {}):
+                    on_disk.add(file_name)
+                else:
+                    os.remove(os.path.join(objects_directory, prefix, file_name))
+        for content_hash, entry in index.get("objects", {}).items():
+            if content_hash in on_disk:
+                self._objects[content_hash] = entry
+                self._total_bytes += entry[0]
+        self._keys = {key: content_hash for key, content_hash in index.get("keys", {}).items()
+                      if content_hash in self._objects}
+
+    def _add(self, temp_path, content_hash, size, keys):
+        # Moves a fully written temporary file into the cache
+        # Returns the path of the cached file, or the data if it can never fit in the cache
+        if size > self.max_bytes:
+            with open(temp_path, "rb") as temp_file:
+                data = temp_file.read()
+            os.remove(temp_path)
+            return data
+        path = self._object_path(content_hash)
+        with self._lock:
+            if content_hash in self._objects:
+                os.remove(temp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temp_path, path)
+                self._objects[content_hash] = [size, 0]
+                self._total_bytes += size
+            for key in keys:
+                self._keys[key] = content_hash
+            self._touch(content_hash)
+            self._evict(keep=content_hash)
+            if time.monotonic() - self._last_save >= self.save_interval:
+                self.save()
+        return path
+
+    def _touch(self, content_hash):
+        # Marks content as most recently used
+        self._clock += 1
+        self._objects[content_hash][1] = self._clock
+        self._dirty = True
+
+    def _evict(self, keep=None):
+        # Removes the least recently used content until the cache fits in max_bytes
+        # The content hash given as keep (the content just added) is never removed
+        if self._total_bytes <= self.max_bytes:
+            return
+        evicted = []
+        remaining_bytes = self._total_bytes
+        for content_hash in sorted(self._objects, key=lambda h: self._objects[h][1]):
+            if remaining_bytes <= self.max_bytes:
+                break
+            if content_hash == keep:
+                continue
+            try:
+                os.remove(self._object_path(content_hash))
+            except OSError:
+                pass
+            remaining_bytes -= self._objects[content_hash][0]
+            evicted.append(content_hash)
+        self._forget(*evicted)
+
+    def _forget(self, *content_hashes):
+        # Drops content and every key pointing to it from the index
+        content_hashes = set(content_hashes)
+        for content_hash in content_hashes:
+            entry = self._objects.pop(content_hash, None)
+            if entry is not None:
+                self._total_bytes -= entry[0]
+        self._keys = {key: value for key, value in self._keys.items() if value not in content_hashes}
+        self._dirty = True
+
+    def _object_path(self, content_hash):
+        return os.path.join(self.directory, OBJECTS_DIRECTORY, content_hash[:2], content_hash)
+
+
+class CacheWriter:
+    """Streams data into a temporary file of an AttachmentCache, hashing it on the way."""
+
+    def __init__(self, cache, keys):
+        self._cache = cache
+        self._keys = tuple(keys)
+        self._hash = hashlib.sha256()
+        self._size = 0
+        self._temp_path = os.path.join(cache.directory, OBJECTS_DIRECTORY,
+                                       "{}.{}.tmp".format(os.getpid(), uuid.uuid4().hex))
+        self._file = open(self._temp_path, "wb")
+
+    def write(self, data):
+        self._hash.update(data)
+        self._size += len(data)
+        self._file.write(data)
+
+    def commit(self):
+        """Store the written data in the cache and return the path of the cached file.
+
+        Data larger than the maximum size of the cache is returned as bytes instead of being stored.
+        """
+        self._file.close()
+        return self._cache._add(self._temp_path, self._hash.hexdigest(), self._size, self._keys)
+
+    def abort(self):
+        """Discard the written data."""
+        self._file.close()
+        os.remove(self._temp_path)
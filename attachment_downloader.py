@@ -0,0 +1,288 @@
+import http.client
+import io
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+# HTTP statuses that are worth retrying
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class AttachmentDownloader:
+    """Downloads MMS attachments concurrently.
+
+    URLs are fetched by a bounded pool of worker threads. Each worker keeps a keep-alive connection open
+    per host, so consecutive downloads from the same server reuse it. Failed downloads are retried with
+    exponential backoff. When an AttachmentCache is given, it is consulted before the network and every
+    successful download is stored in it.
+    """
+
+    def __init__(self, max_workers=8, retries=3, backoff=0.5, timeout=60, cache=None):
+        """Create a downloader.
+
+        :param max_workers: maximum number of concurrent downloads
+        :param retries: number of times a failed download is retried
+        :param backoff: delay in seconds before the first retry, doubled for every further retry
+        :param timeout: socket timeout in seconds
+        :param cache: optional AttachmentCache
+        """
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache = cache
+        self._executor = None
+        self._futures = {}
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        # Downloads may be started and discarded from different threads
+        self._futures_lock = threading.Lock()
+
+    def prefetch(self, urls, aliases=None):
+        """Start downloading the given URLs in the background.
+
+        URLs that are already being downloaded are skipped.
+
+        :param urls: iterable of URLs
+        :param aliases: optional dictionary of URL to other cache keys for the same content (e.g. photo IDs)
+        :return: list of the concurrent.futures.Future of every download
+        """
+        futures = []
+        with self._futures_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            for url in urls:
+                if url is None:
+                    continue
+                future = self._futures.get(url)
+                if future is None:
+                    url_aliases = aliases.get(url, ()) if aliases is not None else ()
+                    future = self._futures[url] = self._executor.submit(self._fetch, url, url_aliases)
+                futures.append(future)
+        return futures
+
+    def get(self, url):
+        """Return the contents of a URL, waiting for its download to finish.
+
+        :param url: URL to download (it does not need to have been prefetched)
+        :return: downloaded bytes, or None if the download failed
+        """
+        data_file = self.open(url)
+        if data_file is None:
+            return None
+        with data_file:
+            return data_file.read()
+
+    def open(self, url):
+        """Open the contents of a URL for reading, waiting for its download to finish.
+
+        Cached downloads are read straight from the cache file, others from memory.
+
+        :param url: URL to download (it does not need to have been prefetched)
+        :return: binary file object, or None if the download failed
+        """
+        try:
+            return open_download(self.result(url))
+        except FileNotFoundError:
+            pass
+        # Evicted from the cache since it was fetched, fetch it again
+        try:
+            return open_download(self._fetch(url, ()))
+        except FileNotFoundError:
+            # Evicted again by concurrent downloads, keep this copy in memory instead
+            return open_download(self._download(url, _MemorySink))
+
+    def result(self, url):
+        """Return the result of downloading a URL, waiting for its download to finish.
+
+        :param url: URL to download (it does not need to have been prefetched)
+        :return: path of the cached file, the downloaded bytes, or None if the download failed
+        """
+        return self.prefetch([url])[0].result()
+
+    def discard(self, urls):
+        """Forget downloaded data that is no longer needed.
+
+        :param urls: iterable of URLs
+        """
+        with self._futures_lock:
+            for url in urls:
+                self._futures.pop(url, None)
+
+    def close(self):
+        """Wait for outstanding downloads and close all connections."""
+        with self._futures_lock:
+            executor = self._executor
+            self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=True)
+        with self._futures_lock:
+            self._futures.clear()
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+        if self.cache is not None:
+            self.cache.save()
+
+    def _fetch(self, url, aliases):
+        # Gets a URL from the cache, or downloads it (into the cache if there is one)
+        # Returns the path of the cached file, the downloaded bytes, or None
+        if self.cache is None:
+            return self._download(url, _MemorySink)
+        path = self.cache.path(url, *aliases)
+        if path is None:
+            keys = (url,) + tuple(aliases)
+            path = self._download(url, lambda: self.cache.writer(keys))
+        return path
+
+    def _download(self, url, sink_factory):
+        # Downloads a URL into a new sink, following redirects and retrying failures
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            sink = sink_factory()
+            try:
+                status = self._request(url, sink)
+            except (OSError, http.client.HTTPException):
+                sink.abort()
+                continue
+            if status == 200:
+                return sink.commit()
+            sink.abort()
+            if status not in RETRY_STATUSES:
+                break
+        return None
+
+    def _request(self, url, sink):
+        # Performs a single GET request, streaming a successful response body into the sink
+        # Returns the final status
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            if parts.scheme not in ("http", "https"):
+                with urllib.request.urlopen(url, timeout=self.timeout) as response:
+                    self._copy(response, sink)
+                    return 200
+            connection = self._get_connection(parts.scheme, parts.netloc)
+            path = urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+            try:
+                connection.request("GET", path)
+                response = connection.getresponse()
+                if response.status == 200:
+                    self._copy(response, sink)
+                else:
+                    # Drain the body so the connection can be reused
+                    response.read()
+            except (OSError, http.client.HTTPException):
+                # The connection may have been closed by the server, start a fresh one next time
+                self._drop_connection(parts.scheme, parts.netloc)
+                raise
+            if response.will_close:
+                self._drop_connection(parts.scheme, parts.netloc)
+            location = response.getheader("Location")
+            if response.status not in REDIRECT_STATUSES or location is None:
+                return response.status
+            url = urllib.parse.urljoin(url, location)
+        return None
+
+    @staticmethod
+    def _copy(response, sink):
+        # Copies a response body into a sink in chunks
+        while True:
+            chunk = response.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            sink.write(chunk)
+
+    def _get_connection(self, scheme, netloc):
+        # Returns this thread's keep-alive connection to a host, creating it if needed
+        connections = getattr(self._local, "connections", None)
+        if connections is None:
+            connections = self._local.connections = {}
+        connection = connections.get((scheme, netloc))
+        if connection is None:
+            if scheme == "https":
+                connection = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+            else:
+                connection = http.client.HTTPConnection(netloc, timeout=self.timeout)
+            connections[(scheme, netloc)] = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    def _drop_connection(self, scheme, netloc):
+        # Closes and forgets this thread's connection to a host
+        connection = self._local.connections.pop((scheme, netloc), None)
+        if connection is not None:
+            connection.close()
+            with self._connections_lock:
+                self._connections.remove(connection)
+
+
+class FetchedAttachments:
+    """Read-only view of attachments that have already been downloaded by an AttachmentDownloader.
+
+    Used in worker processes, which read the downloads of the main process instead of downloading.
+    """
+
+    def __init__(self, results):
+        """Create a view.
+
+        :param results: dictionary of URL to the result of AttachmentDownloader.result
+        """
+        self._results = results
+
+    def open(self, url):
+        """Open the contents of a URL for reading.
+
+        :param url: downloaded URL
+        :return: binary file object, or None if the download failed or the file is gone
+        """
+        try:
+            return open_download(self._results.get(url))
+        except FileNotFoundError:
+            return None
+
+    def result(self, url):
+        """Return the result of downloading a URL.
+
+        :param url: downloaded URL
+        :return: path of the cached file, the downloaded bytes, or None if the download failed
+        """
+        return self._results.get(url)
+
+
+def open_download(result):
+    """Open the result of a download for reading.
+
+    :param result: path of a cached file, downloaded bytes, or None
+    :return: binary file object, or None
+    """
+    if result is None:
+        return None
+    if isinstance(result, str):
+        return open(result, "rb")
+    return io.BytesIO(result)
+
+
+class _MemorySink:
+    # Collects a download in memory
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(data)
+
+    def commit(self):
+        return b"".join(self._chunks)
+
+    def abort(self):
+        self._chunks = []
@@ -0,0 +1,114 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+
+class AttachmentPayloads:
+    """Base64 encoded attachments that have already been written during a conversion.
+
+    The same photo is often sent to several threads. Payloads are stored by the hash of their content
+    and looked up by any of their keys (URL or photo ID), so an attachment that recurs is neither
+    downloaded nor encoded again. The least recently used payloads are dropped once the stored
+    payloads exceed max_bytes. The bytes that did not have to be downloaded or encoded are counted
+    for report().
+    """
+    MAX_BYTES = 128 * 1024 * 1024
+    # Attachments larger than this are always streamed and never stored
+    MAX_PAYLOAD_BYTES = 16 * 1024 * 1024
+
+    def __init__(self, max_bytes=MAX_BYTES, max_payload_bytes=MAX_PAYLOAD_BYTES):
+        """Create an empty store.
+
+        :param max_bytes: maximum total size of the stored payloads in characters
+        :param max_payload_bytes: maximum size in bytes of a single attachment that is stored
+        """
+        self.max_bytes = max_bytes
+        self.max_payload_bytes = max_payload_bytes
+        self.total_bytes = 0
+        self.reused = 0  # Number of attachments written from a stored payload
+        self.download_bytes_saved = 0  # Attachment bytes that were not downloaded again
+        self.encode_bytes_saved = 0  # Attachment bytes that were not base64 encoded again
+        self._payloads = OrderedDict()  # content hash -> (payload, size of the attachment)
+        self._hashes = {}  # key -> content hash
+
+    def get(self, *keys):
+        """Return the stored payload of an attachment, counting it as reused.
+
+        :param keys: keys of the attachment (e.g. its URL and photo ID)
+        :return: base64 payload, or None if it is not stored
+        """
+        for key in keys:
+            content_hash = self._hashes.get(key)
+            if content_hash is not None and content_hash in self._payloads:
+                payload, size = self._payloads[content_hash]
+                self._payloads.move_to_end(content_hash)
+                self._remember(content_hash, keys)
+                self.reused += 1
+                self.download_bytes_saved += size
+                self.encode_bytes_saved += size
+                return payload
+        return None
+
+    def get_content(self, content_hash, keys):
+        """Return the stored payload of downloaded content, counting it as reused.
+
+        Used when an attachment has different keys from an earlier one but the same content.
+
+        :param content_hash: hash of the attachment content (see content_hash())
+        :param keys: keys of the attachment, remembered for later lookups
+        :return: base64 payload, or None if it is not stored
+        """
+        entry = self._payloads.get(content_hash)
+        if entry is None:
+            return None
+        self._payloads.move_to_end(content_hash)
+        self._remember(content_hash, keys)
+        self.reused += 1
+        self.encode_bytes_saved += entry[1]
+        return entry[0]
+
+    def contains(self, *keys):
+        """Return True if the payload of an attachment with any of the keys is stored."""
+        return any(self._hashes.get(key) in self._payloads for key in keys)
+
+    def put(self, content_hash, payload, size, keys):
+        """Store the payload of an attachment.
+
+        :param content_hash: hash of the attachment content (see content_hash())
+        :param payload: base64 payload
+        :param size: size of the attachment in bytes
+        :param keys: keys of the attachment
+        """
+        if size > self.max_payload_bytes or len(payload) > self.max_bytes:
+            return
+        if content_hash not in self._payloads:
+            self._payloads[content_hash] = (payload, size)
+            self.total_bytes += len(payload)
+        self._remember(content_hash, keys)
+        while self.total_bytes > self.max_bytes:
+            _, (evicted, _) = self._payloads.popitem(last=False)
+            self.total_bytes -= len(evicted)
+
+    def report(self):
+        """Return a one line summary of the attachments that were reused."""
+        return "Reused {} duplicate attachments: {:.1f} MB not downloaded, {:.1f} MB not encoded again".format(
+            self.reused, self.download_bytes_saved / 1e6, self.encode_bytes_saved / 1e6)
+
+    @staticmethod
+    def content_hash(result):
+        """Return the content hash of a download.
+
+        :param result: result of AttachmentDownloader.result (a cache file path, bytes or None)
+        :return: hex SHA-256 of the content, or None
+        """
+        if result is None:
+            return None
+        if isinstance(result, str):
+            # Cache files are named by the SHA-256 of their content
+            return os.path.basename(result)
+        return hashlib.sha256(result).hexdigest()
+
+    def _remember(self, content_hash, keys):
+        # Points the keys of an attachment at its content
+        for key in keys:
+            self._hashes[key] = content_hash
@@ -0,0 +1,97 @@
+"""Checks and times the single-pass message body encoding of TitaniumBackupFormatter.
+
+Bodies used to be checked for non-ASCII characters by encoding them to UTF-8, then escaped or encoded
+to UTF-8 again for base64. _encode_body must give exactly the same result: this compares both on every
+message body of a synthetic export with a high share of emoji and other non-ASCII text, and compares
+the XML rendered with each of them. It then times the old path, _encode_body per message and
+_encode_bodies per conversation, and the pickling a separate encoding process would add.
+
+Usage: python benchmarks/bench_body_encoding.py [conversations] [messages per conversation] [unicode ratio]
+"""
+import base64
+import os
+import pickle
+import sys
+import tempfile
+import time
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from hangouts_parser import HangoutsParser  # noqa: E402
+from titanium_backup_formatter import TitaniumBackupFormatter  # noqa: E402
+from synthetic_takeout import SyntheticTakeout  # noqa: E402
+
+USER_PHONE_NUMBER = "+11234567890"
+
+
+def reference_body(text):
+    # The previous encoding: _is_ascii, then escape or _base64_text
+    is_plain = len(text) == len(text.encode())
+    return ("plain", escape(text)) if is_plain else ("base64", base64.b64encode(bytes(text, "utf-8")).decode("utf-8"))
+
+
+class ReferenceFormatter(TitaniumBackupFormatter):
+    """Formatter that encodes bodies the previous way, to compare the rendered XML."""
+
+    @staticmethod
+    def _encode_body(text):
+        return reference_body(text)
+
+
+def render(formatter, conversations, self_gaia_id, file_name):
+    # Returns the XML written for the conversations
+    formatter.create_output_file(conversations, self_gaia_id, file_name)
+    with open(file_name, "rb") as output_file:
+        return output_file.read()
+
+
+def best_time(function, repeat=5):
+    # Returns the shortest of several runs in seconds
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    conversation_count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    message_count = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    unicode_ratio = float(sys.argv[3]) if len(sys.argv) > 3 else 0.5
+    with tempfile.TemporaryDirectory() as directory:
+        input_file = os.path.join(directory, "Hangouts.json")
+        output_file = os.path.join(directory, "messages.xml")
+        SyntheticTakeout(conversations=conversation_count, messages=message_count, chat_ratio=0.0,
+                         attachment_ratio=0.0, unicode_ratio=unicode_ratio).write(input_file)
+        conversations, self_gaia_id = HangoutsParser().parse_input_file(input_file, USER_PHONE_NUMBER)
+        messages = [message for conversation in conversations for message in conversation.messages
+                    if message.content is not None]
+        bodies = [message.content for message in messages]
+        identical_bodies = all(TitaniumBackupFormatter._encode_body(body) == reference_body(body)
+                               for body in bodies)
+        identical_xml = render(TitaniumBackupFormatter(), conversations, self_gaia_id, output_file) == \
+            render(ReferenceFormatter(), conversations, self_gaia_id, output_file)
+
+    encode_body = TitaniumBackupFormatter._encode_body
+    reference_seconds = best_time(lambda: [reference_body(message.content) for message in messages])
+    single_seconds = best_time(lambda: [encode_body(message.content) for message in messages])
+    batch_seconds = best_time(lambda: [TitaniumBackupFormatter._encode_bodies(conversation.messages)
+                                       for conversation in conversations])
+    encoded = TitaniumBackupFormatter._encode_bodies(messages)
+    pickle_seconds = best_time(lambda: (pickle.loads(pickle.dumps(bodies)), pickle.loads(pickle.dumps(encoded))))
+    print("bodies:                {} ({:.0f}% non-ASCII)".format(
+        len(bodies), 100.0 * sum(not body.isascii() for body in bodies) / max(len(bodies), 1)))
+    print("previous encoding:     {:.3f} s".format(reference_seconds))
+    print("_encode_body:          {:.3f} s ({:.2f}x)".format(single_seconds, reference_seconds / single_seconds))
+    print("_encode_bodies:        {:.3f} s ({:.2f}x)".format(batch_seconds, reference_seconds / batch_seconds))
+    print("pickling for a worker: {:.3f} s".format(pickle_seconds))
+    print("identical bodies:      {}".format(identical_bodies))
+    print("identical output:      {}".format(identical_xml))
+    sys.exit(0 if identical_bodies and identical_xml else 1)
+
+
+if __name__ == "__main__":
+    main()
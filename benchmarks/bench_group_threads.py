@@ -0,0 +1,42 @@
+"""Times XML output of large group (MMS) threads.
+
+Every message in a group thread needs the thread's participant addresses, so this measures how well the
+formatter reuses per-thread work across messages.
+
+Usage: python benchmarks/bench_group_threads.py [conversations] [messages per conversation] [group size]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from hangouts_parser import HangoutsParser  # noqa: E402
+from titanium_backup_formatter import TitaniumBackupFormatter  # noqa: E402
+from synthetic_takeout import SyntheticTakeout  # noqa: E402
+
+
+def main():
+    conversation_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    message_count = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    group_size = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    with tempfile.TemporaryDirectory() as directory:
+        input_file = os.path.join(directory, "Hangouts.json")
+        output_file = os.path.join(directory, "messages.xml")
+        SyntheticTakeout(conversations=conversation_count, messages=message_count, group_ratio=1.0,
+                         chat_ratio=0.0, attachment_ratio=0.0, max_group_size=group_size).write(input_file)
+        conversations, self_gaia_id = HangoutsParser().parse_input_file(input_file, "+11234567890")
+        messages = sum(len(conversation.messages) for conversation in conversations)
+        best = None
+        for _ in range(3):
+            start = time.perf_counter()
+            TitaniumBackupFormatter().create_output_file(conversations, self_gaia_id, output_file)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+    print("messages:  {}".format(messages))
+    print("write:     {:.3f} s, {:.0f} messages/s".format(best, messages / best))
+
+
+if __name__ == "__main__":
+    main()
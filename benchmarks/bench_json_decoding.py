@@ -0,0 +1,81 @@
+"""Compares parsing with plain dictionaries against parsing through argparse.Namespace objects.
+
+HangoutsParser decodes every JSON object into a plain dict. Originally every object was turned into an
+argparse.Namespace by an object_hook and its fields were read with getattr; this runs the parser over
+equivalent Namespace objects to measure that path. Both are timed and, separately, measured for their
+peak memory while streaming through a synthetic export.
+
+Usage: python benchmarks/bench_json_decoding.py [conversations] [messages per conversation]
+"""
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import Namespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import hangouts_parser  # noqa: E402
+from json_stream import JsonArrayStream  # noqa: E402
+from synthetic_takeout import SyntheticTakeout  # noqa: E402
+
+
+class AttributeNamespace(Namespace):
+    # Namespace that also answers the dict lookups the parser makes, through attribute access
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+
+def namespace_stream(data_file, key):
+    # JsonArrayStream as the parser used to create it
+    return JsonArrayStream(data_file, key, object_hook=lambda d: AttributeNamespace(**d))
+
+
+def parse(file_name):
+    # Streams through the export, returning the number of messages
+    return sum(len(conversation.messages or ())
+               for conversation in hangouts_parser.HangoutsParser().iter_conversations(file_name, "+11234567890"))
+
+
+def measure(file_name):
+    # Returns the elapsed seconds and the peak traced memory of parsing the export
+    gc.collect()
+    start = time.perf_counter()
+    messages = parse(file_name)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    tracemalloc.start()
+    parse(file_name)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return messages, elapsed, peak
+
+
+def main():
+    conversation_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    message_count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, "Hangouts.json")
+        SyntheticTakeout(conversations=conversation_count, messages=message_count).write(file_name)
+        messages, dict_seconds, dict_peak = measure(file_name)
+        hangouts_parser.JsonArrayStream = namespace_stream
+        try:
+            _, namespace_seconds, namespace_peak = measure(file_name)
+        finally:
+            hangouts_parser.JsonArrayStream = JsonArrayStream
+        input_bytes = os.path.getsize(file_name)
+    print("messages:              {}".format(messages))
+    print("input size:            {:.1f} MB".format(input_bytes / 1e6))
+    for name, seconds, peak in (("Namespace", namespace_seconds, namespace_peak), ("dict", dict_seconds, dict_peak)):
+        print("{:<23}{:.3f} s, {:.0f} messages/s, {:.1f} MB peak".format(name + ":", seconds, messages / seconds,
+                                                                        peak / 1e6))
+    print("speedup:               {:.2f}x".format(namespace_seconds / dict_seconds))
+
+
+if __name__ == "__main__":
+    main()
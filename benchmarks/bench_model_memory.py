@@ -0,0 +1,100 @@
+"""Reports the memory used per parsed message by the data model.
+
+Parses a synthetic Hangouts export twice, once with the slotted model classes and once with equivalent
+classes that keep a per-instance __dict__ (as the model did originally), and prints the memory retained
+by the parsed conversations in bytes per message.
+
+Usage: python benchmarks/bench_model_memory.py [conversations] [messages per conversation]
+"""
+import gc
+import os
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import hangouts_parser  # noqa: E402
+from synthetic_takeout import SyntheticTakeout  # noqa: E402
+
+
+class DictAttachment:
+    def __init__(self, album_id=None, photo_id=None, media_type=None, original_content_url=None, download_url=None):
+        self.album_id = album_id
+        self.photo_id = photo_id
+        self.media_type = media_type
+        self.original_content_url = original_content_url
+        self.download_url = download_url
+
+
+class DictConversation:
+    def __init__(self):
+        self.network_types = None
+        self.active_timestamp = None
+        self.self_latest_read_timestamp = None
+        self.self_gaia_id = None
+        self.participants = None
+        self.messages = None
+
+
+class DictMessage:
+    def __init__(self):
+        self.sender_gaia_id = None
+        self.sender_chat_id = None
+        self.timestamp = None
+        self.medium_type = None
+        self.event_type = None
+        self.content = None
+        self.attachments = None
+
+
+class DictParticipant:
+    def __init__(self):
+        self.name = None
+        self.gaia_id = None
+        self.chat_id = None
+        self.type = None
+        self.e164_number = None
+        self.country_code = None
+        self.international_number = None
+        self.national_number = None
+        self.region_code = None
+        self.latest_read_timestamp = None
+
+
+def measure(file_name):
+    # Returns the bytes retained by the parsed conversations and the number of messages
+    gc.collect()
+    tracemalloc.start()
+    conversations, _ = hangouts_parser.HangoutsParser().parse_input_file(file_name, "+11234567890")
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return retained, sum(len(conversation.messages) for conversation in conversations)
+
+
+def main():
+    conversation_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    message_count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, "Hangouts.json")
+        SyntheticTakeout(conversations=conversation_count, messages=message_count).write(file_name)
+        slotted_bytes, messages = measure(file_name)
+        models = (hangouts_parser.Attachment, hangouts_parser.Conversation,
+                  hangouts_parser.Message, hangouts_parser.Participant)
+        (hangouts_parser.Attachment, hangouts_parser.Conversation,
+         hangouts_parser.Message, hangouts_parser.Participant) = (DictAttachment, DictConversation,
+                                                                  DictMessage, DictParticipant)
+        try:
+            dict_bytes, _ = measure(file_name)
+        finally:
+            (hangouts_parser.Attachment, hangouts_parser.Conversation,
+             hangouts_parser.Message, hangouts_parser.Participant) = models
+    print("messages:              {}".format(messages))
+    print("__dict__ model:        {:.1f} bytes/message".format(dict_bytes / messages))
+    print("__slots__ model:       {:.1f} bytes/message".format(slotted_bytes / messages))
+    print("saved:                 {:.1f}%".format(100.0 * (dict_bytes - slotted_bytes) / dict_bytes))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Compares parsing a Hangouts export with loading it from a ParseCache.
+
+Parses a synthetic export once without a cache, once storing the result in a new cache, and then loads
+it from the cache, checking that the loaded conversations render to exactly the same XML.
+
+Usage: python benchmarks/bench_parse_cache.py [conversations] [messages per conversation]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from hangouts_parser import HangoutsParser  # noqa: E402
+from parse_cache import ParseCache  # noqa: E402
+from titanium_backup_formatter import TitaniumBackupFormatter  # noqa: E402
+from synthetic_takeout import SyntheticTakeout  # noqa: E402
+
+USER_PHONE_NUMBER = "+11234567890"
+
+
+def parse(file_name, cache):
+    # Returns the elapsed seconds, the conversations and the GAIA ID of the user
+    parser = HangoutsParser()
+    start = time.perf_counter()
+    conversations = list(parser.iter_conversations(file_name, USER_PHONE_NUMBER, cache=cache))
+    return time.perf_counter() - start, conversations, parser.self_gaia_id
+
+
+def render(conversations, self_gaia_id, file_name):
+    # Returns the XML written for the conversations
+    TitaniumBackupFormatter().create_output_file(conversations, self_gaia_id, file_name)
+    with open(file_name, "rb") as output_file:
+        return output_file.read()
+
+
+def main():
+    conversation_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    message_count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    with tempfile.TemporaryDirectory() as directory:
+        input_file = os.path.join(directory, "Hangouts.json")
+        output_file = os.path.join(directory, "messages.xml")
+        SyntheticTakeout(conversations=conversation_count, messages=message_count,
+                         attachment_ratio=0).write(input_file)
+        cache = ParseCache(os.path.join(directory, "parse_cache"))
+        parse_seconds, conversations, self_gaia_id = parse(input_file, None)
+        expected = render(conversations, self_gaia_id, output_file)
+        store_seconds, _, _ = parse(input_file, cache)
+        load_seconds, conversations, self_gaia_id = parse(input_file, cache)
+        identical = render(conversations, self_gaia_id, output_file) == expected
+        cache_bytes = sum(entry.stat().st_size for entry in os.scandir(cache.directory))
+        print("messages:              {}".format(sum(len(conversation.messages or ())
+                                                         for conversation in conversations)))
+        print("input size:            {:.1f} MB".format(os.path.getsize(input_file) / 1e6))
+        print("cache size:            {:.1f} MB".format(cache_bytes / 1e6))
+    print("parse:                 {:.3f} s".format(parse_seconds))
+    print("parse and store:       {:.3f} s".format(store_seconds))
+    print("load from cache:       {:.3f} s ({:.1f}x faster)".format(load_seconds, parse_seconds / load_seconds))
+    print("identical output:      {}".format(identical))
+    sys.exit(0 if identical else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Checks and times the fast timestamp formatting of TitaniumBackupFormatter.
+
+The integer-arithmetic formatter must produce exactly the same strings as the datetime-based one. This
+compares both on random timestamps across the whole fast range, on the edges of days, seconds and
+milliseconds, and optionally on every timestamp of a real or synthetic Hangouts export, then times them.
+
+Usage: python benchmarks/bench_timestamps.py [samples] [Hangouts.json]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from hangouts_parser import HangoutsParser  # noqa: E402
+from titanium_backup_formatter import FAST_TIMESTAMP_LIMIT, TitaniumBackupFormatter  # noqa: E402
+
+fast = TitaniumBackupFormatter._timestamp_to_utc_string
+reference = TitaniumBackupFormatter._datetime_timestamp_to_utc_string
+
+
+def sample_timestamps(count, rng):
+    # Random timestamps over the whole fast range, plus values around unit boundaries
+    timestamps = [rng.randrange(FAST_TIMESTAMP_LIMIT) for _ in range(count)]
+    for _ in range(count // 10):
+        base = rng.randrange(FAST_TIMESTAMP_LIMIT // 86400000000) * 86400000000
+        for unit in (1, 1000, 1000000, 60000000, 3600000000, 86400000000):
+            for offset in (-1, 0, 1, 499, 500, 501, 999):
+                timestamps.append(base + unit + offset)
+    timestamps += [0, 1, 999, 1000, FAST_TIMESTAMP_LIMIT - 1]
+    return [timestamp for timestamp in timestamps if 0 <= timestamp < FAST_TIMESTAMP_LIMIT]
+
+
+def export_timestamps(file_name):
+    # Every message timestamp in an export
+    return [message.timestamp for conversation in HangoutsParser().iter_conversations(file_name, "")
+            if conversation.messages is not None for message in conversation.messages]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    rng = random.Random(0)
+    timestamps = sample_timestamps(count, rng)
+    if len(sys.argv) > 2:
+        timestamps += export_timestamps(sys.argv[2])
+    mismatches = [timestamp for timestamp in timestamps if fast(timestamp) != reference(timestamp)]
+    for timestamp in mismatches[:10]:
+        print("Mismatch for {}: {} != {}".format(timestamp, fast(timestamp), reference(timestamp)))
+    print("checked:   {} timestamps, {} mismatches".format(len(timestamps), len(mismatches)))
+    # Time on timestamps that are close together, as messages in a conversation are
+    start = rng.randrange(1262304000000000, 1500000000000000)
+    sequential = [start + index * 37000000 for index in range(count)]
+    for name, function in (("datetime", reference), ("fast", fast)):
+        begin = time.perf_counter()
+        for timestamp in sequential:
+            function(timestamp)
+        elapsed = time.perf_counter() - begin
+        print("{:<10} {:.0f} timestamps/s".format(name + ":", count / elapsed))
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
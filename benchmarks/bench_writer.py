@@ -0,0 +1,43 @@
+"""Measures XML output throughput in messages per second for different writer buffer sizes.
+
+Usage: python benchmarks/bench_writer.py [conversations] [messages per conversation]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from hangouts_parser import HangoutsParser  # noqa: E402
+from titanium_backup_formatter import TitaniumBackupFormatter  # noqa: E402
+from synthetic_takeout import SyntheticTakeout  # noqa: E402
+
+BUFFER_SIZES = (4 * 1024, 64 * 1024, 1024 * 1024, 8 * 1024 * 1024)
+
+
+def main():
+    conversation_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    message_count = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    with tempfile.TemporaryDirectory() as directory:
+        input_file = os.path.join(directory, "Hangouts.json")
+        output_file = os.path.join(directory, "messages.xml")
+        SyntheticTakeout(conversations=conversation_count, messages=message_count, chat_ratio=0.0,
+                         attachment_ratio=0.0).write(input_file)
+        conversations, self_gaia_id = HangoutsParser().parse_input_file(input_file, "+11234567890")
+        messages = sum(len(conversation.messages) for conversation in conversations)
+        print("messages: {}".format(messages))
+        for buffer_size in BUFFER_SIZES:
+            best = None
+            for _ in range(3):
+                start = time.perf_counter()
+                TitaniumBackupFormatter(buffer_size=buffer_size).create_output_file(conversations, self_gaia_id,
+                                                                                    output_file)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            print("buffer {:>8} KB: {:10.0f} messages/s {:8.1f} MB/s".format(
+                buffer_size // 1024, messages / best, os.path.getsize(output_file) / best / 1e6))
+
+
+if __name__ == "__main__":
+    main()
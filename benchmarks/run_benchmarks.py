@@ -0,0 +1,99 @@
+"""Times and memory-profiles parsing and XML output on a synthetic Hangouts export.
+
+HangoutsParser.parse_input_file and TitaniumBackupFormatter.create_output_file are measured separately.
+Attachments are served by a local AttachmentServer. Each stage is run once for timing and, with
+--memory, once more under tracemalloc for its peak memory.
+
+Usage: python benchmarks/run_benchmarks.py --conversations 200 --messages 500 [--memory] [--json results.json]
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from hangouts_parser import HangoutsParser  # noqa: E402
+from titanium_backup_formatter import TitaniumBackupFormatter  # noqa: E402
+from synthetic_takeout import AttachmentServer, add_arguments, from_arguments  # noqa: E402
+
+USER_PHONE_NUMBER = "+11234567890"
+
+
+def measure(function, memory):
+    """Run a function, returning its result, elapsed seconds and peak traced memory in bytes (or None)."""
+    gc.collect()
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def run(arguments, directory, server):
+    # Generates the export and measures both stages
+    input_file = os.path.join(directory, "Hangouts.json")
+    output_file = os.path.join(directory, "messages.xml")
+    message_total = from_arguments(arguments, server.url).write(input_file)
+    results = {"conversations": arguments.conversations, "messages": message_total,
+               "input_bytes": os.path.getsize(input_file)}
+
+    def parse():
+        return HangoutsParser().parse_input_file(input_file, USER_PHONE_NUMBER)
+
+    (conversations, self_gaia_id), results["parse_seconds"], _ = measure(parse, False)
+    if arguments.memory:
+        _, _, results["parse_peak_bytes"] = measure(parse, True)
+
+    def write():
+        TitaniumBackupFormatter(processes=arguments.processes).create_output_file(conversations, self_gaia_id,
+                                                                                  output_file)
+
+    _, results["write_seconds"], _ = measure(write, False)
+    results["attachment_requests"] = server.requests
+    if arguments.memory:
+        _, _, results["write_peak_bytes"] = measure(write, True)
+    results["output_bytes"] = os.path.getsize(output_file)
+    return results
+
+
+def report(results):
+    print("conversations:       {}".format(results["conversations"]))
+    print("messages:            {}".format(results["messages"]))
+    print("input size:          {:.1f} MB".format(results["input_bytes"] / 1e6))
+    print("output size:         {:.1f} MB".format(results["output_bytes"] / 1e6))
+    print("attachment requests: {}".format(results["attachment_requests"]))
+    for stage in ("parse", "write"):
+        seconds = results[stage + "_seconds"]
+        print("{:<21}{:.3f} s, {:.0f} messages/s".format(stage + ":", seconds, results["messages"] / seconds))
+        if stage + "_peak_bytes" in results:
+            print("{:<21}{:.1f} MB".format(stage + " peak memory:", results[stage + "_peak_bytes"] / 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument("--attachment-size", type=int, default=64 * 1024, help="size of every attachment in bytes")
+    parser.add_argument("--processes", type=int, default=1, help="number of processes rendering threads")
+    parser.add_argument("--memory", action="store_true", help="also measure peak memory (slow)")
+    parser.add_argument("--json", help="write the results to this JSON file")
+    arguments = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory, AttachmentServer(arguments.attachment_size) as server:
+        results = run(arguments, directory, server)
+    report(results)
+    if arguments.json:
+        with open(arguments.json, "w") as results_file:
+            json.dump(results, results_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+"""Generates synthetic Google Takeout Hangouts.json files for benchmarking.
+
+The generated files follow the structure of real exports (conversation_state entries with participant
+data, read states and events with segments and Google Photos attachments), with configurable size and mix
+of content. Attachment URLs point at an AttachmentServer, a local HTTP stand-in for Google Photos.
+
+Usage: python benchmarks/synthetic_takeout.py Hangouts.json --conversations 1000 --messages 500
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+SELF_GAIA_ID = "100000000000000000001"
+ASCII_WORDS = ("hey", "ok", "see", "you", "at", "the", "store", "later", "thanks", "<lol>", "&", "dinner", "?")
+UNICODE_WORDS = ("héllo", "naïve", "😀", "👍🏽", "☃", "日本語", "привет", "mañana", "🎉🎉")
+MEDIA_TYPES = ("PHOTO", "ANIMATED_PHOTO", "VIDEO")
+
+
+class SyntheticTakeout:
+    """Describes and writes a synthetic Hangouts export."""
+
+    def __init__(self, conversations=100, messages=100, group_ratio=0.2, chat_ratio=0.2, unicode_ratio=0.2,
+                 attachment_ratio=0.02, attachment_pool=100, link_ratio=0.05, line_break_ratio=0.1,
+                 max_group_size=8, attachment_url="http://127.0.0.1:8000", seed=0):
+        """Describe a synthetic export.
+
+        :param conversations: number of conversations
+        :param messages: number of messages per conversation
+        :param group_ratio: fraction of SMS conversations that are group (MMS) conversations
+        :param chat_ratio: fraction of conversations that are Hangouts chats rather than SMS
+        :param unicode_ratio: fraction of messages containing non-ASCII text
+        :param attachment_ratio: fraction of messages with a photo/GIF/video attachment
+        :param attachment_pool: number of distinct attachments (attachments are reused across messages)
+        :param link_ratio: fraction of messages containing a LINK segment
+        :param line_break_ratio: fraction of messages containing a LINE_BREAK segment
+        :param max_group_size: maximum number of other participants in a group conversation
+        :param attachment_url: base URL of the attachment server
+        :param seed: random seed, the same settings and seed always produce the same file
+        """
+        self.conversations = conversations
+        self.messages = messages
+        self.group_ratio = group_ratio
+        self.chat_ratio = chat_ratio
+        self.unicode_ratio = unicode_ratio
+        self.attachment_ratio = attachment_ratio
+        self.attachment_pool = attachment_pool
+        self.link_ratio = link_ratio
+        self.line_break_ratio = line_break_ratio
+        self.max_group_size = max_group_size
+        self.attachment_url = attachment_url.rstrip("/")
+        self.seed = seed
+
+    def write(self, file_name):
+        """Write the export to a file, one conversation at a time.
+
+        :param file_name: name of the Hangouts JSON file to create
+        :return: total number of messages written
+        """
+        rng = random.Random(self.seed)
+        message_total = 0
+        with open(file_name, "w", encoding="utf-8") as export_file:
+            export_file.write('{"continuation_end_timestamp": "1500000000000000", "conversation_state": [')
+            for index in range(self.conversations):
+                if index > 0:
+                    export_file.write(",")
+                conversation_state = self._conversation_state(rng, index)
+                message_total += len(conversation_state["conversation_state"]["event"])
+                json.dump(conversation_state, export_file, ensure_ascii=False)
+            export_file.write("]}")
+        return message_total
+
+    def _conversation_state(self, rng, index):
+        # Builds a single entry of the conversation_state list
+        conversation_id = {"id": "Ugw{:012d}".format(index)}
+        is_chat = rng.random() < self.chat_ratio
+        other_count = rng.randint(2, self.max_group_size) if rng.random() < self.group_ratio else 1
+        others = [str(200000000000000000000 + index * 100 + number) for number in range(other_count)]
+        participant_data = [self._participant(SELF_GAIA_ID, "Me", None)]
+        for number, gaia_id in enumerate(others):
+            phone = None if is_chat else "+1555{:03d}{:04d}".format(index % 1000, number)
+            participant_data.append(self._participant(gaia_id, "Person {}-{}".format(index, number), phone))
+        start = 1262304000000000 + rng.randrange(0, 10 ** 14)
+        events = []
+        timestamp = start
+        for _ in range(self.messages):
+            timestamp += rng.randrange(1, 3600 * 10 ** 6)
+            sender = SELF_GAIA_ID if rng.random() < 0.5 else rng.choice(others)
+            events.append(self._event(rng, conversation_id, sender, timestamp, is_chat))
+        return {
+            "conversation_id": conversation_id,
+            "conversation_state": {
+                "conversation_id": conversation_id,
+                "conversation": {
+                    "id": conversation_id,
+                    "type": "GROUP" if other_count > 1 else "STICKY_ONE_TO_ONE",
+                    "self_conversation_state": {
+                        "self_read_state": {"participant_id": self._participant_id(SELF_GAIA_ID),
+                                            "latest_read_timestamp": str(timestamp)},
+                        "status": "ACTIVE",
+                        "notification_level": "RING",
+                        "view": ["INBOX_VIEW"],
+                        "sort_timestamp": str(timestamp),
+                        "active_timestamp": str(timestamp),
+                    },
+                    "read_state": [{"participant_id": self._participant_id(gaia_id),
+                                    "latest_read_timestamp": str(timestamp)} for gaia_id in others],
+                    "has_active_hangout": False,
+                    "otr_status": "ON_THE_RECORD",
+                    "otr_toggle": "ENABLED",
+                    "current_participant": [self._participant_id(gaia_id) for gaia_id in [SELF_GAIA_ID] + others],
+                    "participant_data": participant_data,
+                    "fork_on_external_invite": False,
+                    "network_type": ["BABEL"] if is_chat else ["PHONE"],
+                    "force_history_state": "NO_FORCE",
+                    "group_link_sharing_status": "LINK_SHARING_OFF",
+                },
+                "event": events,
+            },
+        }
+
+    def _event(self, rng, conversation_id, sender, timestamp, is_chat):
+        # Builds a chat message event
+        segments = []
+        word_count = rng.randint(1, 30)
+        words = UNICODE_WORDS + ASCII_WORDS if rng.random() < self.unicode_ratio else ASCII_WORDS
+        segments.append({"type": "TEXT", "text": " ".join(rng.choice(words) for _ in range(word_count))})
+        if rng.random() < self.line_break_ratio:
+            segments.append({"type": "LINE_BREAK", "text": "\n"})
+            segments.append({"type": "TEXT", "text": rng.choice(ASCII_WORDS),
+                             "formatting": {"bold": rng.random() < 0.5}})
+        if rng.random() < self.link_ratio:
+            url = "https://example.com/{}".format(rng.randrange(10 ** 6))
+            segments.append({"type": "LINK", "text": url,
+                             "link_data": {"link_target": url, "display_url": url}})
+        message_content = {"segment": segments}
+        if rng.random() < self.attachment_ratio:
+            photo_id = rng.randrange(self.attachment_pool)
+            message_content["attachment"] = [self._attachment(rng, photo_id)]
+        event = {
+            "conversation_id": conversation_id,
+            "sender_id": self._participant_id(sender),
+            "timestamp": str(timestamp),
+            "self_event_state": {"user_id": self._participant_id(SELF_GAIA_ID),
+                                 "notification_level": "RING"},
+            "chat_message": {"message_content": message_content},
+            "event_id": "7-H0Z7{:012d}".format(rng.randrange(10 ** 12)),
+            "advances_sort_timestamp": True,
+            "event_otr": "ON_THE_RECORD",
+            "delivery_medium": {"medium_type": "BABEL_MEDIUM" if is_chat else "GOOGLE_VOICE_MEDIUM"},
+            "event_type": "REGULAR_CHAT_MESSAGE",
+            "event_version": str(timestamp),
+        }
+        return event
+
+    def _attachment(self, rng, photo_id):
+        # Builds a Google Photos attachment
+        url = "{}/attachment/{}".format(self.attachment_url, photo_id)
+        return {"embed_item": {
+            "type": ["PLUS_PHOTO"],
+            "id": "{}/{}".format(SELF_GAIA_ID, photo_id),
+            "embeds.PlusPhoto.plus_photo": {
+                "thumbnail": {"url": url, "image_url": url, "width_px": 640, "height_px": 480},
+                "owner_obfuscated_id": SELF_GAIA_ID,
+                "album_id": "6000000000000000000",
+                "photo_id": str(photo_id),
+                "url": url,
+                "original_content_url": url,
+                "media_type": MEDIA_TYPES[photo_id % len(MEDIA_TYPES)],
+                "download_url": url + "?download",
+            },
+        }}
+
+    @staticmethod
+    def _participant_id(gaia_id):
+        return {"gaia_id": gaia_id, "chat_id": gaia_id}
+
+    def _participant(self, gaia_id, name, phone):
+        participant = {"id": self._participant_id(gaia_id), "fallback_name": name,
+                       "invitation_status": "ACCEPTED_INVITATION",
+                       "participant_type": "GAIA" if phone is None else "OFF_NETWORK_PHONE",
+                       "new_invitation_status": "ACCEPTED_INVITATION"}
+        if phone is not None:
+            participant["phone_number"] = {"e164": phone, "i18n_data": {
+                "national_number": "({}) {}-{}".format(phone[2:5], phone[5:8], phone[8:]),
+                "international_number": "+1 {}-{}-{}".format(phone[2:5], phone[5:8], phone[8:]),
+                "country_code": 1, "region_code": "US", "is_valid": True, "validation_result": "IS_POSSIBLE"}}
+        return participant
+
+
+class AttachmentServer:
+    """Local HTTP stand-in for Google Photos.
+
+    Serves /attachment/<id> with deterministic content of a fixed size and counts the requests it gets.
+    """
+
+    def __init__(self, attachment_size=64 * 1024, port=0):
+        """Create a server.
+
+        :param attachment_size: size in bytes of every attachment
+        :param port: port to listen on, 0 picks a free port
+        """
+        self.attachment_size = attachment_size
+        self.requests = 0
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self._server.server_address[1])
+
+    def content(self, attachment_id):
+        """Return the content served for an attachment."""
+        seed = hashlib.sha256(attachment_id.encode()).digest()
+        return (seed * (self.attachment_size // len(seed) + 1))[:self.attachment_size]
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server.requests += 1
+                path = self.path.split("?")[0]
+                if not path.startswith("/attachment/"):
+                    self.send_error(404)
+                    return
+                body = server.content(path[len("/attachment/"):])
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def add_arguments(parser):
+    """Add the export settings to an argparse parser."""
+    parser.add_argument("--conversations", type=int, default=100, help="number of conversations")
+    parser.add_argument("--messages", type=int, default=100, help="messages per conversation")
+    parser.add_argument("--group-ratio", type=float, default=0.2, help="fraction of group conversations")
+    parser.add_argument("--chat-ratio", type=float, default=0.2, help="fraction of Hangouts chat conversations")
+    parser.add_argument("--unicode-ratio", type=float, default=0.2, help="fraction of non-ASCII messages")
+    parser.add_argument("--attachment-ratio", type=float, default=0.02, help="fraction of messages with media")
+    parser.add_argument("--attachment-pool", type=int, default=100, help="number of distinct attachments")
+    parser.add_argument("--link-ratio", type=float, default=0.05, help="fraction of messages with a LINK")
+    parser.add_argument("--line-break-ratio", type=float, default=0.1, help="fraction of messages with a LINE_BREAK")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+
+
+def from_arguments(arguments, attachment_url="http://127.0.0.1:8000"):
+    """Create a SyntheticTakeout from parsed arguments."""
+    return SyntheticTakeout(conversations=arguments.conversations, messages=arguments.messages,
+                            group_ratio=arguments.group_ratio, chat_ratio=arguments.chat_ratio,
+                            unicode_ratio=arguments.unicode_ratio, attachment_ratio=arguments.attachment_ratio,
+                            attachment_pool=arguments.attachment_pool, link_ratio=arguments.link_ratio,
+                            line_break_ratio=arguments.line_break_ratio, attachment_url=attachment_url,
+                            seed=arguments.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("output", help="Hangouts JSON file to create")
+    parser.add_argument("--attachment-url", default="http://127.0.0.1:8000", help="base URL of attachments")
+    add_arguments(parser)
+    arguments = parser.parse_args()
+    message_total = from_arguments(arguments, arguments.attachment_url).write(arguments.output)
+    print("Wrote {} conversations, {} messages to {}".format(arguments.conversations, message_total,
+                                                            arguments.output))
+
+
+if __name__ == "__main__":
+    main()
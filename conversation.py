@@ -3,16 +3,22 @@ class Conversation:
 
     Model that describes a thread of SMS or MMS messages and participants.
     """
-    network_types = None  # SMS/MMS seem to use PHONE
-    active_timestamp = None  # Not used
-    self_latest_read_timestamp = None  # Not used
-    participants = None
-    messages = None
+    __slots__ = (
+        "conversation_id",
+        "network_types",  # SMS/MMS seem to use PHONE
+        "active_timestamp",  # Last activity; older conversations are skipped when adding to a previous output
+        "self_latest_read_timestamp",  # Not used
+        "self_gaia_id",  # GAIA ID of the user, as known when the conversation was parsed
+        "participants",
+        "messages",
+    )
 
     def __init__(self, network_types=None, participants=None, active_timestamp=None,
-                 self_read_timestamp=None, messages=None):
+                 self_read_timestamp=None, messages=None, self_gaia_id=None, conversation_id=None):
+        self.conversation_id = conversation_id
         self.network_types = network_types
         self.active_timestamp = active_timestamp
         self.self_latest_read_timestamp = self_read_timestamp
+        self.self_gaia_id = self_gaia_id
         self.participants = participants
         self.messages = messages
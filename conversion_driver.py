@@ -0,0 +1,142 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Marks the end of the conversations in a queue
+_END = object()
+
+
+class ConversionDriver:
+    """Runs a conversion as concurrent asyncio stages connected by bounded queues.
+
+    Parsing runs in its own thread and fills a queue of parsed conversations. The fetch stage starts
+    downloading the attachments of every conversation it takes from that queue and passes each one on
+    as soon as its downloads are done, so text-only threads reach the writer straight away instead of
+    waiting behind a slow MMS thread. The writer stage is TitaniumBackupFormatter.create_output_file,
+    run in a thread and fed from the queue of ready conversations.
+
+    The queues and the number of conversations waiting for downloads are bounded: when the writer
+    falls behind, fetching and then parsing pause, so memory use stays capped however large the input
+    is. Threads are written in the order their attachments become ready rather than the input order,
+    which makes no difference to Titanium Backup.
+    """
+    QUEUE_SIZE = 16
+    MAX_FETCHING = 32
+
+    def __init__(self, formatter, queue_size=QUEUE_SIZE, max_fetching=MAX_FETCHING):
+        """Create a driver.
+
+        :param formatter: TitaniumBackupFormatter that downloads attachments and writes the output; its
+            prefetch_depth should be 0, since the driver already downloads ahead of the writer
+        :param queue_size: maximum number of conversations waiting in each queue between stages
+        :param max_fetching: maximum number of conversations whose attachments are being downloaded at once
+        """
+        self.formatter = formatter
+        self.queue_size = queue_size
+        self.max_fetching = max_fetching
+
+    def run(self, conversations, self_gaia_id, output_file_name, checkpoint_directory=None, checkpoint_key=None):
+        """Convert conversations to Titanium Backup XML, blocking until the output is complete.
+
+        :param conversations: iterable of Conversation objects, e.g. from HangoutsParser.iter_conversations
+        :param self_gaia_id: GAIA ID of the user, or None to use the ID recorded on each Conversation
+        :param output_file_name: name of the output XML file
+        :param checkpoint_directory: optional staging directory for resuming interrupted conversions
+        :param checkpoint_key: optional key of the conversion, see TitaniumBackupFormatter.create_output_file
+        :return: list of the names of the files written
+        """
+        return asyncio.run(self.convert(conversations, self_gaia_id, output_file_name, checkpoint_directory,
+                                        checkpoint_key))
+
+    async def convert(self, conversations, self_gaia_id, output_file_name, checkpoint_directory=None,
+                      checkpoint_key=None):
+        """Coroutine version of run()."""
+        loop = asyncio.get_running_loop()
+        parsed = asyncio.Queue(self.queue_size)
+        ready = asyncio.Queue(self.queue_size)
+        with ThreadPoolExecutor(max_workers=1) as parse_executor, \
+                ThreadPoolExecutor(max_workers=1) as write_executor:
+            parse_task = asyncio.ensure_future(self._parse(conversations, parsed, ready, parse_executor))
+            fetch_task = asyncio.ensure_future(self._fetch(parsed, ready))
+            writer = write_executor.submit(self.formatter.create_output_file, self._ready_conversations(ready, loop),
+                                           self_gaia_id, output_file_name, checkpoint_directory, checkpoint_key)
+            try:
+                return await asyncio.wrap_future(writer)
+            finally:
+                parse_task.cancel()
+                fetch_task.cancel()
+                await asyncio.gather(parse_task, fetch_task, return_exceptions=True)
+                if not writer.done():
+                    # Interrupted: make the writer stop instead of waiting for more conversations
+                    while not ready.empty():
+                        ready.get_nowait()
+                    ready.put_nowait(asyncio.CancelledError())
+                    await asyncio.gather(asyncio.wrap_future(writer), return_exceptions=True)
+
+    async def _parse(self, conversations, parsed, ready, executor):
+        # Pulls conversations from the (blocking) iterable in a thread and queues them for fetching
+        # Errors are passed on to the writer, which raises them
+        loop = asyncio.get_running_loop()
+        iterator = iter(conversations)
+        try:
+            while True:
+                conversation = await loop.run_in_executor(executor, next, iterator, _END)
+                await parsed.put(conversation)
+                if conversation is _END:
+                    return
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await ready.put(e)
+
+    async def _fetch(self, parsed, ready):
+        # Starts the downloads of each parsed conversation and queues it for writing once they are done
+        # Errors are passed on to the writer, which raises them
+        fetching = asyncio.Semaphore(self.max_fetching)
+        tasks = set()
+        try:
+            while True:
+                conversation = await parsed.get()
+                if conversation is _END:
+                    break
+                await fetching.acquire()
+                task = asyncio.ensure_future(self._fetch_conversation(conversation, ready, fetching))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+            await ready.put(_END)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await ready.put(e)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _fetch_conversation(self, conversation, ready, fetching):
+        # Waits for the attachments of a conversation, then queues it for writing
+        try:
+            futures = self.formatter.prefetch_attachments(conversation)
+            if futures:
+                # Failed downloads are reported by the writer when it gets their result
+                await asyncio.wait([asyncio.wrap_future(future) for future in futures])
+            await ready.put(conversation)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Queued in place of the conversation, so the writer fails instead of leaving the thread out
+            await ready.put(e)
+        finally:
+            fetching.release()
+
+    @staticmethod
+    def _ready_conversations(ready, loop):
+        # Yields the conversations queued for writing; runs in the writer thread
+        while True:
+            conversation = asyncio.run_coroutine_threadsafe(ready.get(), loop).result()
+            if conversation is _END:
+                return
+            if isinstance(conversation, BaseException):
+                raise conversation
+            yield conversation
@@ -1,14 +1,23 @@
-import json
-from argparse import Namespace
+import os
 from participant import Participant
 from message import Message
 from conversation import Conversation
 from attachment import Attachment
+from json_stream import JsonArrayStream
+from metrics import ConversionMetrics
 
 
 class HangoutsParser:
     """Parses the Google Takeout JSON export for Hangouts SMS/MMS messages."""
 
+    def __init__(self, metrics=None):
+        """Create a parser.
+
+        :param metrics: ConversionMetrics the parsing stages, counts and progress are recorded in
+        """
+        self.self_gaia_id = None  # gaia_id for the phone owner, once it has been seen
+        self.metrics = metrics if metrics is not None else ConversionMetrics()
+
     def parse_input_file(self, hangouts_file_name, user_phone_number):
         """Parse the Hangouts JSON file containing SMS/MMS messages.
 
@@ -16,49 +25,147 @@ class HangoutsParser:
         :param user_phone_number: phone number of the user (some messages are missing this)
         :return: list of Conversation objects, GAIA ID of the user
         """
-        conversations = []
-        self_gaia_id = None  # gaia_id for the phone owner
-        with open(hangouts_file_name, 'rb') as data_file:
-            # Read the Hangouts JSON file and turn into objects
-            data = json.load(data_file, object_hook=lambda d: Namespace(**d))
+        conversations = list(self.iter_conversations(hangouts_file_name, user_phone_number))
+        return conversations, self.self_gaia_id
+
+    def iter_conversations(self, hangouts_file_name, user_phone_number, min_active_timestamp=None, network_type=None,
+                           cache=None):
+        """Incrementally parse the Hangouts JSON file, one conversation at a time.
+
+        Only the conversation currently being parsed is held in memory, so memory use is bounded by the
+        largest conversation instead of the size of the whole export.
+        The GAIA ID of the user is available in self_gaia_id as soon as it has been seen.
+
+        :param hangouts_file_name: filename of the Hangouts messages
+        :param user_phone_number: phone number of the user (some messages are missing this)
+        :param min_active_timestamp: optional timestamp (microseconds); conversations last active before it
+                                     are skipped without parsing their participants and messages
+        :param network_type: optional network type (e.g. "PHONE"); conversations not on it are skipped
+                             without parsing their participants and messages
+        :param cache: optional ParseCache; if it holds this file parsed with the same phone number and
+                      network type, the conversations are loaded from it, otherwise they are stored in it once
+                      all are parsed. The cache holds every conversation, whatever min_active_timestamp is, so
+                      one entry serves all later conversions of the file
+        :return: generator of Conversation objects
+        """
+        self.self_gaia_id = None
+        if cache is None:
+            yield from self._parse_conversations(hangouts_file_name, user_phone_number, min_active_timestamp,
+                                                 network_type)
+            return
+        key = cache.key(hangouts_file_name, user_phone_number, network_type)
+        parsed_conversations = cache.open(key)
+        if parsed_conversations is not None:
+            yield from self._load_conversations(parsed_conversations, min_active_timestamp)
+            return
+        cache_writer = cache.writer(key)
+        try:
+            for conversation in self._parse_conversations(hangouts_file_name, user_phone_number, None,
+                                                          network_type):
+                cache_writer.add(conversation)
+                if self._is_active(conversation, min_active_timestamp):
+                    yield conversation
+            cache_writer.commit(self.self_gaia_id)
+        finally:
+            cache_writer.close()
+
+    def _parse_conversations(self, hangouts_file_name, user_phone_number, min_active_timestamp, network_type):
+        # Parses the conversations of the Hangouts JSON file one at a time
+        with open(hangouts_file_name, 'r', encoding='utf-8-sig') as data_file:
+            # Read the Hangouts JSON file, decoding each conversation into plain dictionaries
+            conversation_states = iter(JsonArrayStream(data_file, "conversation_state"))
+            input_size = os.fstat(data_file.fileno()).st_size
             # Iterate through each conversation in the list
-            for conversation_state in data.conversation_state:
-                # Get the nested conversation_state
-                state = getattr(conversation_state, "conversation_state", None)
-                if state is not None:
-                    # Get the conversation object
-                    conversation = getattr(state, "conversation", None)
-                    if conversation is None:
-                        continue
-                    # Create a new conversation and store its properties
-                    current_conversation = Conversation()
-                    current_conversation.network_types = getattr(conversation, "network_type", None)
-                    self_conversation_state = getattr(conversation, "self_conversation_state", None)
-                    if self_conversation_state is not None:
-                        current_conversation.active_timestamp = self._try_int_attribute(self_conversation_state,
-                                                                                       "active_timestamp")
-                        self_read_state = getattr(self_conversation_state, "self_read_state", None)
-                        if self_read_state is not None:
-                            current_conversation.self_latest_read_timestamp = \
-                                self._try_int_attribute(self_read_state, "latest_read_timestamp")
-                            participant_id = getattr(self_read_state, "participant_id", None)
-                            if participant_id is not None:
-                                current_self_gaia_id = self._try_int_attribute(participant_id, "gaia_id")
-                                if current_self_gaia_id is not None:
-                                    self_gaia_id = current_self_gaia_id
-                    # Get the conversation participants
-                    participant_data = getattr(conversation, "participant_data", None)
-                    read_state = getattr(conversation, "read_state", None)
-                    if participant_data is not None:
-                        current_conversation.participants = self._extract_participants(conversation.participant_data,
-                                                                                       read_state, user_phone_number,
-                                                                                       self_gaia_id)
-                    # Get the conversation messages
-                    events = getattr(state, "event", None)
-                    if events is not None:
-                        current_conversation.messages = self._process_messages(events)
-                    conversations.append(current_conversation)
-        return conversations, self_gaia_id
+            while True:
+                with self.metrics.timer("decode"):
+                    conversation_state = next(conversation_states, None)
+                if conversation_state is None:
+                    break
+                current_conversation = self._process_conversation_state(conversation_state, user_phone_number,
+                                                                        min_active_timestamp, network_type)
+                # Progress is the part of the file that has been read
+                self.metrics.update_progress(data_file.buffer.tell() / input_size if input_size else 1.0)
+                if current_conversation is not None:
+                    yield current_conversation
+            self.metrics.finish_progress()
+
+    def _load_conversations(self, parsed_conversations, min_active_timestamp=None):
+        # Yields the conversations of a parse cache file that were active since min_active_timestamp, one at a time
+        try:
+            total = len(parsed_conversations)
+            for index in range(total):
+                with self.metrics.timer("cache_load"):
+                    current_conversation = parsed_conversations[index]
+                if current_conversation.self_gaia_id is not None:
+                    self.self_gaia_id = current_conversation.self_gaia_id
+                self.metrics.count("conversations_parsed")
+                if current_conversation.messages is not None:
+                    self.metrics.count("messages_parsed", len(current_conversation.messages))
+                self.metrics.update_progress((index + 1) / total)
+                if self._is_active(current_conversation, min_active_timestamp):
+                    yield current_conversation
+            self.self_gaia_id = parsed_conversations.self_gaia_id
+            self.metrics.finish_progress()
+        finally:
+            parsed_conversations.close()
+
+    def _process_conversation_state(self, conversation_state, user_phone_number, min_active_timestamp=None,
+                                    network_type=None):
+        # Parses a single entry of the conversation_state list
+        # Get the nested conversation_state
+        state = conversation_state.get("conversation_state")
+        if state is None:
+            return None
+        # Get the conversation object
+        conversation = state.get("conversation")
+        if conversation is None:
+            return None
+        # Create a new conversation and store its properties
+        current_conversation = Conversation()
+        conversation_id = conversation.get("id")
+        if conversation_id is not None:
+            current_conversation.conversation_id = conversation_id.get("id")
+        current_conversation.network_types = conversation.get("network_type")
+        self_conversation_state = conversation.get("self_conversation_state")
+        if self_conversation_state is not None:
+            current_conversation.active_timestamp = self._try_int_value(self_conversation_state, "active_timestamp")
+            self_read_state = self_conversation_state.get("self_read_state")
+            if self_read_state is not None:
+                current_conversation.self_latest_read_timestamp = \
+                    self._try_int_value(self_read_state, "latest_read_timestamp")
+                participant_id = self_read_state.get("participant_id")
+                if participant_id is not None:
+                    current_self_gaia_id = self._try_int_value(participant_id, "gaia_id")
+                    if current_self_gaia_id is not None:
+                        self.self_gaia_id = current_self_gaia_id
+        current_conversation.self_gaia_id = self.self_gaia_id
+        # Skip unwanted conversations now that the GAIA ID of the user has been read from them
+        if network_type is not None and network_type not in (current_conversation.network_types or ()):
+            return None
+        if not self._is_active(current_conversation, min_active_timestamp):
+            return None
+        # Get the conversation participants
+        participant_data = conversation.get("participant_data")
+        read_state = conversation.get("read_state")
+        if participant_data is not None:
+            with self.metrics.timer("participants"):
+                current_conversation.participants = self._extract_participants(participant_data,
+                                                                               read_state, user_phone_number,
+                                                                               self.self_gaia_id)
+        # Get the conversation messages
+        events = state.get("event")
+        if events is not None:
+            with self.metrics.timer("messages"):
+                current_conversation.messages = self._process_messages(events)
+            self.metrics.count("messages_parsed", len(current_conversation.messages))
+        self.metrics.count("conversations_parsed")
+        return current_conversation
+
+    @staticmethod
+    def _is_active(conversation, min_active_timestamp):
+        # Returns False for a conversation last active before min_active_timestamp
+        return min_active_timestamp is None or type(conversation.active_timestamp) is not int \
+            or conversation.active_timestamp >= min_active_timestamp
 
     def _extract_participants(self, participant_data, read_state, user_phone_number, self_gaia_id):
         # Builds a dictionary of the participants in a conversation/thread
@@ -66,21 +173,21 @@ class HangoutsParser:
         for participant in participant_data:
             # Create a new participant and store its properties
             current_participant = Participant()
-            current_participant.name = getattr(participant, "fallback_name", None)
-            participant_id = getattr(participant, "id", None)
-            current_participant.chat_id = self._try_int_attribute(participant_id, "chat_id")
-            current_participant.gaia_id = self._try_int_attribute(participant_id, "gaia_id")
-            current_participant.type = getattr(participant, "participant_type", None)
+            current_participant.name = participant.get("fallback_name")
+            participant_id = participant.get("id")
+            current_participant.chat_id = self._try_int_value(participant_id, "chat_id")
+            current_participant.gaia_id = self._try_int_value(participant_id, "gaia_id")
+            current_participant.type = participant.get("participant_type")
             # Parse participant phone details
-            phone_number = getattr(participant, "phone_number", None)
+            phone_number = participant.get("phone_number")
             if phone_number is not None:
-                current_participant.e164_number = getattr(phone_number, "e164", None)
-                i18n_data = getattr(phone_number, "i18n_data", None)
+                current_participant.e164_number = phone_number.get("e164")
+                i18n_data = phone_number.get("i18n_data")
                 if i18n_data is not None:
-                    current_participant.country_code = getattr(i18n_data, "country_code", None)
-                    current_participant.international_number = getattr(i18n_data, "international_number", None)
-                    current_participant.national_number = getattr(i18n_data, "national_number", None)
-                    current_participant.region_code = getattr(i18n_data, "region_code", None)
+                    current_participant.country_code = i18n_data.get("country_code")
+                    current_participant.international_number = i18n_data.get("international_number")
+                    current_participant.national_number = i18n_data.get("national_number")
+                    current_participant.region_code = i18n_data.get("region_code")
             # Sometimes the phone number is missing...
             # This only seems to happen for the user, not others
             if (current_participant.gaia_id is not None
@@ -94,9 +201,9 @@ class HangoutsParser:
         # Parse read_state to get latest_read_timestamp for each participant
         if read_state is not None:
             for participant_read_state in read_state:
-                participant_id = getattr(participant_read_state, "participant_id", None)
-                gaia_id = self._try_int_attribute(participant_id, "gaia_id")
-                latest_read_timestamp = self._try_int_attribute(participant_read_state, "latest_read_timestamp")
+                participant_id = participant_read_state.get("participant_id")
+                gaia_id = self._try_int_value(participant_id, "gaia_id")
+                latest_read_timestamp = self._try_int_value(participant_read_state, "latest_read_timestamp")
                 if gaia_id in participant_list.keys():
                     participant_list[gaia_id].latest_read_timestamp = latest_read_timestamp
         return participant_list
@@ -104,35 +211,40 @@ class HangoutsParser:
     def _process_messages(self, events):
         # Parses events/messages in a conversation
         message_list = []
+        # Sender IDs and types repeat for every message, so share one object per distinct value
+        shared_values = {}
         for event in events:
             # Create new message and store its properties
             current_message = Message()
-            sender_id = getattr(event, "sender_id", None)
-            current_message.sender_gaia_id = self._try_int_attribute(sender_id, "gaia_id")
-            current_message.sender_chat_id = self._try_int_attribute(sender_id, "chat_id")
-            current_message.timestamp = self._try_int_attribute(event, "timestamp")
-            delivery_medium = getattr(event, "delivery_medium", None)
+            sender_id = event.get("sender_id")
+            gaia_id = self._try_int_value(sender_id, "gaia_id")
+            current_message.sender_gaia_id = shared_values.setdefault(gaia_id, gaia_id)
+            chat_id = self._try_int_value(sender_id, "chat_id")
+            current_message.sender_chat_id = shared_values.setdefault(chat_id, chat_id)
+            current_message.timestamp = self._try_int_value(event, "timestamp")
+            delivery_medium = event.get("delivery_medium")
             if delivery_medium is not None:
-                current_message.medium_type = getattr(delivery_medium, "medium_type", None)
-            current_message.event_type = getattr(event, "event_type", None)
+                medium_type = delivery_medium.get("medium_type")
+                current_message.medium_type = shared_values.setdefault(medium_type, medium_type)
+            event_type = event.get("event_type")
+            current_message.event_type = shared_values.setdefault(event_type, event_type)
             # Parse message chat content
-            chat_message = getattr(event, "chat_message", None)
+            chat_message = event.get("chat_message")
             if chat_message is not None:
-                message_content = getattr(chat_message, "message_content", None)
+                message_content = chat_message.get("message_content")
                 if message_content is not None:
-                    if hasattr(message_content, "segment"):
-                        current_message.content = self._process_message_content(message_content.segment)
-                    if hasattr(message_content, "attachment"):
-                        current_message.attachments = self._process_message_attachments(message_content.attachment)
+                    if "segment" in message_content:
+                        current_message.content = self._process_message_content(message_content["segment"])
+                    if "attachment" in message_content:
+                        current_message.attachments = self._process_message_attachments(message_content["attachment"])
             message_list.append(current_message)
         return message_list
 
-    @staticmethod
-    def _process_message_content(segment_list):
+    def _process_message_content(self, segment_list):
         # Parse the content/body of a message
-        message_content = ""
+        texts = []
         for current_segment in segment_list:
-            if hasattr(current_segment, "formatting"):
+            if "formatting" in current_segment:
                 # TODO: FORMATTING tag handling
                 # formatting
                 #    bold = boolean
@@ -140,55 +252,56 @@ class HangoutsParser:
                 #    strikethrough = boolean
                 #    underline = boolean
                 pass
-            if hasattr(current_segment, "type"):
-                if hasattr(current_segment, "text"):
-                    message_content += current_segment.text
+            segment_type = current_segment.get("type")
+            if segment_type is not None:
+                if "text" in current_segment:
+                    texts.append(current_segment["text"])
 
-                if current_segment.type == "TEXT":
+                if segment_type == "TEXT":
                     pass
-                elif current_segment.type == "LINE_BREAK":
+                elif segment_type == "LINE_BREAK":
                     pass
-                elif current_segment.type == "LINK":
+                elif segment_type == "LINK":
                     # TODO: LINK type handling
                     # link_data
                     #    display_url = string
                     #    link_target = string
                     pass
                 else:
-                    print("Error: Unknown message content TYPE: " + current_segment.type)
+                    self.metrics.error("segment_type", "Error: Unknown message content TYPE: " + segment_type)
                     continue
             else:
-                print("Error: Message content missing TYPE!")
+                self.metrics.error("segment_type", "Error: Message content missing TYPE!")
                 continue
-        return message_content
+        return "".join(texts)
 
     def _process_message_attachments(self, attachment_list):
         # Parse the attachments of an MMS message
         attachments = []
         for current_attachment in attachment_list:
-            embed_item = getattr(current_attachment, "embed_item", None)
+            embed_item = current_attachment.get("embed_item")
             if embed_item is not None:
-                plus_photo = getattr(embed_item, "embeds.PlusPhoto.plus_photo", None)
+                plus_photo = embed_item.get("embeds.PlusPhoto.plus_photo")
                 if plus_photo is not None:
                     current_attachment = Attachment()
-                    current_attachment.album_id = self._try_int_attribute(plus_photo, "album_id")
-                    current_attachment.photo_id = self._try_int_attribute(plus_photo, "photo_id")
-                    current_attachment.media_type = getattr(plus_photo, "media_type", None)
-                    current_attachment.original_content_url = getattr(plus_photo, "original_content_url", None)
-                    current_attachment.download_url = getattr(plus_photo, "download_url", None)
+                    current_attachment.album_id = self._try_int_value(plus_photo, "album_id")
+                    current_attachment.photo_id = self._try_int_value(plus_photo, "photo_id")
+                    current_attachment.media_type = plus_photo.get("media_type")
+                    current_attachment.original_content_url = plus_photo.get("original_content_url")
+                    current_attachment.download_url = plus_photo.get("download_url")
                     attachments.append(current_attachment)
         return attachments
 
     @staticmethod
-    def _try_int_attribute(obj, attribute_name):
-        # Return the integer value in the object with the specified name
+    def _try_int_value(obj, key):
+        # Return the integer value in the JSON object with the specified key
         # If it cannot be cast as an int, return whatever it actually is
         result = None
-        if obj is not None and attribute_name is not None:
-            temp_attr = getattr(obj, attribute_name, None)
-            if temp_attr is not None:
+        if obj is not None and key is not None:
+            temp_value = obj.get(key)
+            if temp_value is not None:
                 try:
-                    result = int(temp_attr)
+                    result = int(temp_value)
                 except ValueError:
-                    result = temp_attr
+                    result = temp_value
         return result
@@ -1,19 +1,116 @@
+import argparse
 from hangouts_parser import HangoutsParser
 from titanium_backup_formatter import TitaniumBackupFormatter
+from attachment_downloader import AttachmentDownloader
+from attachment_cache import AttachmentCache
+from titanium_index import TitaniumBackupIndex
+from metrics import ConversionMetrics
+from parse_cache import ParseCache, file_key
+from conversion_driver import ConversionDriver
+from xml_writer import BufferedXmlWriter
 
 
 # Configuration constants
 HANGOUTS_JSON_FILE = 'Hangouts.json'
 OUTPUT_FILE = "messages.xml"
 YOUR_PHONE_NUMBER = "+11234567890"
+DOWNLOAD_THREADS = 8  # Number of attachments downloaded concurrently
+CACHE_DIRECTORY = "attachment_cache"  # Downloaded attachments are kept here for later runs
+CACHE_MAX_BYTES = 4 * 1024 * 1024 * 1024
+PARSE_CACHE_DIRECTORY = "parse_cache"  # Parsed conversations are kept here, so the same export is only parsed once
+CHECKPOINT_DIRECTORY = None  # If set (e.g. "checkpoint"), an interrupted conversion resumes from the threads kept here
+PROCESSES = 1  # Number of processes rendering threads in parallel (e.g. os.cpu_count())
+MAX_FILE_BYTES = None  # If set, the output is split over messages-001.xml, messages-002.xml... of about this size
+MAX_FILE_MESSAGES = None  # If set, the output is split over numbered files with at most this many messages each
+METRICS_FILE = None  # If set, timings, counts and errors of the conversion are saved to this JSON file
+PREVIOUS_OUTPUT_FILE = None  # Output of an earlier conversion; if set, only newer messages are added to it
+QUEUE_SIZE = ConversionDriver.QUEUE_SIZE  # Conversations waiting between the parsing, fetching and writing stages
+MAX_FETCHING = ConversionDriver.MAX_FETCHING  # Conversations whose attachments are downloaded at the same time
+BUFFER_SIZE = BufferedXmlWriter.BUFFER_SIZE  # Characters of output collected before they are written to the file
 
 
-# Parse the Hangouts data and output Titanium Backup XML
-hangouts_parser = HangoutsParser()
-titanium_output = TitaniumBackupFormatter()
-print("Parsing Hangouts data file...")
-conversations, self_gaia_id = hangouts_parser.parse_input_file(HANGOUTS_JSON_FILE, YOUR_PHONE_NUMBER)
-print("Done.")
-print("Converting to SMS export file...")
-titanium_output.create_output_file(conversations, self_gaia_id, OUTPUT_FILE)
-print("Done.")
+def parse_arguments(argv=None):
+    """Parse the command line; options that are not given default to the configuration constants above."""
+    parser = argparse.ArgumentParser(description="Convert a Google Takeout Hangouts.json file to a Titanium Backup "
+                                                 "SMS/MMS XML file.")
+    parser.add_argument("input", nargs="?", default=HANGOUTS_JSON_FILE,
+                        help="Hangouts JSON file (default: %(default)s)")
+    parser.add_argument("output", nargs="?", default=OUTPUT_FILE, help="output XML file (default: %(default)s)")
+    parser.add_argument("-p", "--phone", default=YOUR_PHONE_NUMBER,
+                        help="your phone number, including the country code (default: %(default)s)")
+    parser.add_argument("--previous", default=PREVIOUS_OUTPUT_FILE, metavar="FILE",
+                        help="output of an earlier conversion; only newer messages are added to it")
+    parser.add_argument("--download-threads", type=int, default=DOWNLOAD_THREADS, metavar="N",
+                        help="attachments downloaded concurrently (default: %(default)s)")
+    parser.add_argument("--max-fetching", type=int, default=MAX_FETCHING, metavar="N",
+                        help="conversations whose attachments are downloaded at the same time (default: %(default)s)")
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE, metavar="N",
+                        help="conversations waiting between the parsing, fetching and writing stages "
+                             "(default: %(default)s)")
+    parser.add_argument("--processes", type=int, default=PROCESSES, metavar="N",
+                        help="processes rendering threads in parallel (default: %(default)s)")
+    parser.add_argument("--buffer-size", type=int, default=BUFFER_SIZE, metavar="CHARS",
+                        help="characters of output collected before they are written (default: %(default)s)")
+    parser.add_argument("--max-file-bytes", type=int, default=MAX_FILE_BYTES, metavar="BYTES",
+                        help="split the output over numbered files of about this size")
+    parser.add_argument("--max-file-messages", type=int, default=MAX_FILE_MESSAGES, metavar="N",
+                        help="split the output over numbered files with at most this many messages each")
+    parser.add_argument("--cache-dir", default=CACHE_DIRECTORY, metavar="DIR",
+                        help="directory downloaded attachments are kept in (default: %(default)s)")
+    parser.add_argument("--cache-max-bytes", type=int, default=CACHE_MAX_BYTES, metavar="BYTES",
+                        help="maximum size of the attachment cache (default: %(default)s)")
+    parser.add_argument("--parse-cache-dir", default=PARSE_CACHE_DIRECTORY, metavar="DIR",
+                        help="directory parsed conversations are kept in (default: %(default)s)")
+    parser.add_argument("--checkpoint-dir", default=CHECKPOINT_DIRECTORY, metavar="DIR",
+                        help="keep completed threads in this directory until the output is finished, so an "
+                             "interrupted conversion can resume; every thread is then written twice")
+    parser.add_argument("--metrics-file", default=METRICS_FILE, metavar="FILE",
+                        help="save timings, counts and errors of the conversion to this JSON file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Parse the Hangouts data and output Titanium Backup XML."""
+    args = parse_arguments(argv)
+    metrics = ConversionMetrics(progress=True)
+    metrics.install()
+    hangouts_parser = HangoutsParser(metrics=metrics)
+    attachment_cache = AttachmentCache(args.cache_dir, max_bytes=args.cache_max_bytes)
+    parse_cache = ParseCache(args.parse_cache_dir)
+    titanium_output = TitaniumBackupFormatter(AttachmentDownloader(max_workers=args.download_threads,
+                                                                   cache=attachment_cache),
+                                              processes=args.processes, buffer_size=args.buffer_size,
+                                              metrics=metrics, max_file_bytes=args.max_file_bytes,
+                                              max_file_messages=args.max_file_messages)
+    if args.previous is not None:
+        print("Adding new Hangouts messages to the previous SMS export file...")
+        index = TitaniumBackupIndex.from_xml(args.previous)
+        # Conversations without activity since the previous conversion are skipped while parsing
+        latest_timestamp = index.latest_timestamp
+        conversations = hangouts_parser.iter_conversations(
+            args.input, args.phone,
+            min_active_timestamp=latest_timestamp * 1000 if latest_timestamp is not None else None,
+            network_type="PHONE", cache=parse_cache)
+        titanium_output.create_delta_file(conversations, None, args.output, index, previous_file_name=args.previous)
+    else:
+        print("Converting Hangouts data file to SMS export file...")
+        # Parsing, attachment downloads and writing run concurrently, without loading the whole file first
+        # Hangouts chats are not SMS/MMS, so they are skipped while parsing
+        conversations = hangouts_parser.iter_conversations(args.input, args.phone, network_type="PHONE",
+                                                           cache=parse_cache)
+        titanium_output.prefetch_depth = 0  # The driver downloads attachments ahead of the writer itself
+        driver = ConversionDriver(titanium_output, queue_size=args.queue_size, max_fetching=args.max_fetching)
+        # Threads left in the checkpoint by a conversion of another file or phone number are not reused
+        checkpoint_key = file_key(args.input, args.phone, "PHONE") if args.checkpoint_dir else None
+        driver.run(conversations, None, args.output, checkpoint_directory=args.checkpoint_dir or None,
+                   checkpoint_key=checkpoint_key)
+    print(titanium_output.payloads.report())
+    for line in metrics.summary():
+        print(line)
+    if args.metrics_file is not None:
+        metrics.dump(args.metrics_file)
+    print("Done.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import json
+
+
+JSON_WHITESPACE = " \t\n\r"
+# Characters that can continue a number, e.g. after a cut at "1." or "1e+"
+JSON_NUMBER_CHARS = "0123456789.eE+-"
+
+
+class JsonArrayStream:
+    """Incrementally decodes the items of an array member of a top-level JSON object.
+
+    The file is read in chunks and the array items are decoded one at a time, so only the item
+    currently being decoded (plus one chunk of look-ahead) is held in memory.
+    """
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, data_file, key, object_hook=None, chunk_size=CHUNK_SIZE):
+        """Create a stream over the items of an array.
+
+        :param data_file: text file object containing a JSON object
+        :param key: name of the top-level member that holds the array
+        :param object_hook: optional hook applied to every decoded JSON object (as in json.load)
+        :param chunk_size: number of characters to read from the file at a time
+        """
+        self._file = data_file
+        self._key = key
+        self._decoder = json.JSONDecoder(object_hook=object_hook)
+        self._chunk_size = chunk_size
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+
+    def __iter__(self):
+        self._expect("{")
+        if self._peek() == "}":
+            return
+        while True:
+            key = self._decode_value()
+            self._expect(":")
+            if key == self._key:
+                yield from self._iter_array()
+            else:
+                # Other top-level members are small, just decode and drop them
+                self._decode_value()
+            if self._next_char() == "}":
+                return
+            self._pos -= 1
+            self._expect(",")
+
+    def _iter_array(self):
+        # Yields each item of the array starting at the current position
+        self._expect("[")
+        if self._peek() == "]":
+            self._pos += 1
+            return
+        while True:
+            yield self._decode_value()
+            if self._next_char() == "]":
+                return
+            self._pos -= 1
+            self._expect(",")
+
+    def _fill(self, min_size=0):
+        # Discards the consumed part of the buffer and appends the next chunk of the file
+        data = self._file.read(max(self._chunk_size, min_size))
+        self._buffer = self._buffer[self._pos:] + data
+        self._pos = 0
+        if not data:
+            self._eof = True
+        return bool(data)
+
+    def _peek(self):
+        # Returns the next non-whitespace character without consuming it
+        while True:
+            while self._pos < len(self._buffer):
+                if self._buffer[self._pos] not in JSON_WHITESPACE:
+                    return self._buffer[self._pos]
+                self._pos += 1
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON data")
+
+    def _next_char(self):
+        # Consumes and returns the next non-whitespace character
+        char = self._peek()
+        self._pos += 1
+        return char
+
+    def _expect(self, expected):
+        char = self._next_char()
+        if char != expected:
+            raise ValueError("Expected '{}' but found '{}' in JSON data".format(expected, char))
+
+    def _decode_value(self):
+        # Decodes the JSON value at the current position, reading more of the file as needed
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            else:
+                # A number that reaches the end of the buffer, or stops at a character that can continue it,
+                # may have been cut off and decoded as a shorter prefix
+                if self._eof or (end < len(self._buffer) and self._buffer[end] not in JSON_NUMBER_CHARS):
+                    self._pos = end
+                    return value
+            # Grow the buffer geometrically so large values are not re-decoded too many times
+            self._fill(len(self._buffer) - self._pos)
@@ -3,13 +3,15 @@ class Message:
 
     Model that describes a message.
     """
-    sender_gaia_id = None  # This seems to be the ID to use
-    sender_chat_id = None  # Not used
-    timestamp = None
-    medium_type = None  # Not used
-    event_type = None  # Not used
-    content = None  # Message body
-    attachments = None  # MMS attachments
+    __slots__ = (
+        "sender_gaia_id",  # This seems to be the ID to use
+        "sender_chat_id",  # Not used
+        "timestamp",
+        "medium_type",  # Not used
+        "event_type",  # Not used
+        "content",  # Message body
+        "attachments",  # MMS attachments
+    )
 
     def __init__(self, sender_gaia_id=None, sender_chat_id=None, timestamp=None,
                  medium_type=None, event_type=None, content=None, attachments=None):
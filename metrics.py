@@ -0,0 +1,169 @@
+import json
+import sys
+import time
+from contextlib import contextmanager
+
+
+# ConversionMetrics that report_error() delivers to, see ConversionMetrics.install()
+_installed = None
+
+
+class ConversionMetrics:
+    """Timers, counters, errors and progress of a conversion.
+
+    Stages (JSON decoding, rendering, attachment fetching, writing...) add up their elapsed time, and
+    counters keep totals such as messages and bytes written. Errors are counted by category: each
+    distinct error message is printed the first time it occurs, and repeats only show up in the totals
+    instead of flooding the console. With progress enabled, the fraction done, message rate and an
+    estimated time remaining are shown on a single updating line.
+    """
+    # Minimum number of seconds between progress updates
+    PROGRESS_INTERVAL = 1.0
+
+    def __init__(self, progress=False, progress_file=None):
+        """Create empty metrics.
+
+        :param progress: show live progress
+        :param progress_file: text file progress is shown on (stderr by default)
+        """
+        self.timers = {}
+        self.counters = {}
+        self.errors = {}
+        self.progress = progress
+        self.progress_file = progress_file if progress_file is not None else sys.stderr
+        self._printed_errors = set()
+        self._start = time.perf_counter()
+        self._last_progress = None
+
+    @contextmanager
+    def timer(self, stage):
+        """Context manager adding the time spent in the block to a stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def add_time(self, stage, seconds):
+        """Add elapsed seconds to a stage."""
+        self.timers[stage] = self.timers.get(stage, 0.0) + seconds
+
+    def count(self, name, amount=1):
+        """Add to a counter."""
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def error(self, category, message):
+        """Record an error, printing its message only the first time it occurs.
+
+        :param category: short name the error is counted under
+        :param message: message shown to the user
+        """
+        self.errors[category] = self.errors.get(category, 0) + 1
+        if message not in self._printed_errors:
+            self._printed_errors.add(message)
+            self._clear_progress()
+            print(message)
+
+    def install(self):
+        """Make these metrics receive the errors reported with report_error()."""
+        global _installed
+        _installed = self
+
+    def state(self):
+        """Return the timers, counters and errors as a dictionary (e.g. to send from a worker process)."""
+        return {"timers": dict(self.timers), "counters": dict(self.counters), "errors": dict(self.errors)}
+
+    def clear(self):
+        """Reset the timers, counters and errors; messages already printed are still not repeated."""
+        self.timers.clear()
+        self.counters.clear()
+        self.errors.clear()
+
+    def merge(self, state):
+        """Add the timers, counters and errors returned by state() of other metrics."""
+        for stage, seconds in state["timers"].items():
+            self.add_time(stage, seconds)
+        for name, amount in state["counters"].items():
+            self.count(name, amount)
+        for category, amount in state["errors"].items():
+            self.errors[category] = self.errors.get(category, 0) + amount
+
+    def update_progress(self, fraction):
+        """Show progress, at most once per PROGRESS_INTERVAL.
+
+        :param fraction: fraction of the conversion that is done, from 0 to 1
+        """
+        if not self.progress:
+            return
+        now = time.perf_counter()
+        if self._last_progress is not None and now - self._last_progress < self.PROGRESS_INTERVAL:
+            return
+        self._last_progress = now
+        elapsed = now - self._start
+        messages = self.counters.get("messages_written", 0)
+        line = "{:5.1f}%  {} messages  {:.0f} messages/s".format(100.0 * fraction, messages,
+                                                                 messages / elapsed if elapsed > 0 else 0)
+        if 0 < fraction < 1:
+            line += "  ETA {}".format(self._format_seconds(elapsed * (1 - fraction) / fraction))
+        self.progress_file.write("\r" + line.ljust(60))
+        self.progress_file.flush()
+
+    def finish_progress(self):
+        """End the progress line."""
+        if self.progress and self._last_progress is not None:
+            self.progress_file.write("\n")
+            self.progress_file.flush()
+            self._last_progress = None
+
+    def elapsed(self):
+        """Return the seconds since the metrics were created."""
+        return time.perf_counter() - self._start
+
+    def summary(self):
+        """Return a human readable summary, one line per item."""
+        elapsed = self.elapsed()
+        lines = ["Elapsed: {:.1f} s".format(elapsed)]
+        messages = self.counters.get("messages_written", 0)
+        if elapsed > 0:
+            lines.append("Messages written: {} ({:.0f} messages/s)".format(messages, messages / elapsed))
+        for name in sorted(self.counters):
+            if name != "messages_written":
+                lines.append("{}: {}".format(name.replace("_", " ").capitalize(), self.counters[name]))
+        for stage in sorted(self.timers):
+            lines.append("Time in {}: {:.2f} s".format(stage.replace("_", " "), self.timers[stage]))
+        for category in sorted(self.errors):
+            lines.append("Errors ({}): {}".format(category.replace("_", " "), self.errors[category]))
+        return lines
+
+    def dump(self, file_name):
+        """Write the metrics to a JSON file."""
+        state = self.state()
+        state["elapsed_seconds"] = self.elapsed()
+        with open(file_name, "w", encoding="utf-8") as metrics_file:
+            json.dump(state, metrics_file, indent=2, sort_keys=True)
+
+    def _clear_progress(self):
+        # Moves past the progress line so other output does not overwrite it
+        if self.progress and self._last_progress is not None:
+            self.progress_file.write("\n")
+            self.progress_file.flush()
+
+    @staticmethod
+    def _format_seconds(seconds):
+        minutes, seconds = divmod(int(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        return "{}:{:02d}:{:02d}".format(hours, minutes, seconds)
+
+
+def report_error(category, message):
+    """Record an error in the installed ConversionMetrics, or print it if none are installed.
+
+    For code without access to the metrics of the conversion, such as the model classes.
+
+    :param category: short name the error is counted under
+    :param message: message shown to the user
+    """
+    if _installed is not None:
+        _installed.error(category, message)
+    else:
+        print(message)
@@ -0,0 +1,409 @@
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from array import array
+from functools import lru_cache
+from attachment import Attachment
+from conversation import Conversation
+from message import Message
+from participant import Participant
+
+
+MAGIC = b"HGPCACHE"
+VERSION = 1
+HASH_CHUNK_SIZE = 1024 * 1024
+# Collected columns and values are moved to temporary files once they take up this many bytes
+SPILL_SIZE = 4 * 1024 * 1024
+# Columns are aligned to this many bytes in the file, so they can be read in place
+COLUMN_ALIGNMENT = 8
+# Kinds of values in the value table
+NONE_VALUE = 0
+STR_VALUE = 1
+INT_VALUE = 2
+JSON_VALUE = 3
+# No list/dictionary (e.g. Message.attachments is None), stored in place of a count
+NO_ITEMS = -1
+
+CONVERSATION_FIELDS = ("conversation_id", "network_types", "active_timestamp", "self_latest_read_timestamp",
+                       "self_gaia_id")
+PARTICIPANT_FIELDS = ("name", "gaia_id", "chat_id", "type", "e164_number", "country_code", "international_number",
+                      "national_number", "region_code", "latest_read_timestamp")
+MESSAGE_FIELDS = ("sender_gaia_id", "sender_chat_id", "timestamp", "medium_type", "event_type", "content")
+ATTACHMENT_FIELDS = ("album_id", "photo_id", "media_type", "original_content_url", "download_url")
+# Fields whose values are nearly always unique, so they are not looked up or kept for reuse
+UNSHARED_FIELDS = ("timestamp", "content", "photo_id", "original_content_url", "download_url")
+# Columns that are not value indexes: name -> array type code
+RANGE_COLUMNS = {"conversations.participant_start": "q", "conversations.participant_count": "q",
+                 "conversations.message_start": "q", "conversations.message_count": "q",
+                 "messages.attachment_start": "q", "messages.attachment_count": "q",
+                 "values.kind": "B", "values.offset": "Q"}
+
+
+class ParseCache:
+    """Directory of parsed Hangouts exports in a compact columnar format.
+
+    Parsing a large Hangouts.json is the slowest part of a conversion. The parsed conversations can be
+    stored here, keyed by the SHA-256 of the input file and the parsing options, so later conversions of
+    the same export load them from a memory mapped file instead of decoding the JSON again.
+
+    Only the most recently used entries are kept; older ones are deleted when a new one is written.
+    """
+    MAX_ENTRIES = 2
+
+    def __init__(self, directory, max_entries=MAX_ENTRIES):
+        """Open (or create) a cache directory.
+
+        :param directory: directory the cache files are kept in
+        :param max_entries: maximum number of parsed exports kept in the directory
+        """
+        self.directory = directory
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, input_file_name, *options):
+        """Return the cache key of an input file parsed with the given options.
+
+        :param input_file_name: name of the Hangouts JSON file
+        :param options: parsing options that change the result
+        :return: hex string
+        """
+        return file_key(input_file_name, *options)
+
+    def open(self, key):
+        """Open the parsed conversations stored under a key.
+
+        :param key: cache key from key()
+        :return: ParsedConversations, or None if nothing usable is stored
+        """
+        try:
+            parsed_conversations = ParsedConversations(self._path(key))
+        except (OSError, ValueError):
+            return None
+        try:
+            # The modification time records the last use, see _evict()
+            os.utime(self._path(key))
+        except OSError:
+            pass
+        return parsed_conversations
+
+    def writer(self, key):
+        """Return a ParseCacheWriter storing conversations under a key, making room for it in the cache."""
+        self._evict(self.max_entries - 1)
+        return ParseCacheWriter(self._path(key))
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".bin")
+
+    def _evict(self, keep):
+        # Deletes all but the keep most recently used cache files
+        entries = []
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith(".bin"):
+                path = os.path.join(self.directory, file_name)
+                try:
+                    entries.append((os.path.getmtime(path), path))
+                except OSError:
+                    pass
+        entries.sort(reverse=True)
+        for _, path in entries[max(keep, 0):]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class ParseCacheWriter:
+    """Collects parsed conversations into columns and writes them to a cache file.
+
+    Every field is stored as an index into a table of distinct values, so repeated values such as
+    sender IDs and types are only stored once; message bodies are stored without looking for repeats.
+    Columns and values are moved to temporary files next to the cache file as they grow, so memory use
+    does not grow with the input. The file only appears once commit() is called.
+    """
+
+    def __init__(self, path):
+        """Create a writer.
+
+        :param path: name of the cache file
+        """
+        self.path = path
+        self._columns = {}
+        for table, fields in (("conversations", CONVERSATION_FIELDS), ("participants", PARTICIPANT_FIELDS),
+                              ("messages", MESSAGE_FIELDS), ("attachments", ATTACHMENT_FIELDS)):
+            for field in fields:
+                self._columns[table + "." + field] = array("I")
+        for name, typecode in RANGE_COLUMNS.items():
+            self._columns[name] = array(typecode)
+        # Value 0 is None
+        self._columns["values.kind"].append(NONE_VALUE)
+        self._columns["values.offset"].extend((0, 0))
+        self._data = bytearray()
+        self._value_indexes = {}
+        # Spilled part of every column and of the value data: name -> [temporary file, number of items]
+        self._spilled = {name: [None, 0] for name in list(self._columns) + ["values.data"]}
+
+    def add(self, conversation):
+        """Add a parsed Conversation."""
+        columns = self._columns
+        self._add_fields("conversations", CONVERSATION_FIELDS, conversation)
+        participants = conversation.participants
+        columns["conversations.participant_start"].append(self._length("participants.gaia_id"))
+        columns["conversations.participant_count"].append(NO_ITEMS if participants is None else len(participants))
+        for participant in (participants or {}).values():
+            self._add_fields("participants", PARTICIPANT_FIELDS, participant)
+        messages = conversation.messages
+        columns["conversations.message_start"].append(self._length("messages.timestamp"))
+        columns["conversations.message_count"].append(NO_ITEMS if messages is None else len(messages))
+        for message in messages or ():
+            self._add_fields("messages", MESSAGE_FIELDS, message)
+            attachments = message.attachments
+            columns["messages.attachment_start"].append(self._length("attachments.album_id"))
+            columns["messages.attachment_count"].append(NO_ITEMS if attachments is None else len(attachments))
+            for attachment in attachments or ():
+                self._add_fields("attachments", ATTACHMENT_FIELDS, attachment)
+        if sum(len(column) * column.itemsize for column in columns.values()) + len(self._data) >= SPILL_SIZE:
+            self._spill()
+
+    def commit(self, self_gaia_id=None):
+        """Write the cache file.
+
+        :param self_gaia_id: GAIA ID of the user found while parsing
+        """
+        header = {"byteorder": sys.byteorder, "self_gaia_id": self_gaia_id, "columns": {}}
+        offset = 0
+        for name, column in self._columns.items():
+            header["columns"][name] = [offset, column.typecode, self._length(name)]
+            offset = _aligned(offset + self._length(name) * column.itemsize)
+        header["columns"]["values.data"] = [offset, "B", self._length("values.data")]
+        header_data = json.dumps(header).encode("utf-8")
+        start = _aligned(len(MAGIC) + 8 + len(header_data))
+        try:
+            with open(self.path + ".tmp", "wb") as cache_file:
+                cache_file.write(MAGIC + struct.pack("<II", VERSION, len(header_data)) + header_data)
+                for name, column in list(self._columns.items()) + [("values.data", self._data)]:
+                    cache_file.write(b"\0" * (start + header["columns"][name][0] - cache_file.tell()))
+                    spill_file = self._spilled[name][0]
+                    if spill_file is not None:
+                        spill_file.seek(0)
+                        shutil.copyfileobj(spill_file, cache_file)
+                    cache_file.write(column)
+            os.replace(self.path + ".tmp", self.path)
+        finally:
+            self.close()
+
+    def close(self):
+        """Remove the temporary files; called by commit(), or to give up on a cache file."""
+        for entry in self._spilled.values():
+            if entry[0] is not None:
+                entry[0].close()
+                entry[0] = None
+
+    def _length(self, name):
+        # Returns the number of items in a column (or bytes in the value data), including spilled ones
+        return self._spilled[name][1] + len(self._columns[name] if name != "values.data" else self._data)
+
+    def _spill(self):
+        # Appends the collected columns and value data to their temporary files and empties them
+        for name, column in list(self._columns.items()) + [("values.data", self._data)]:
+            if not column:
+                continue
+            entry = self._spilled[name]
+            if entry[0] is None:
+                entry[0] = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(self.path)))
+            entry[0].write(column)
+            entry[1] += len(column)
+            del column[:]
+
+    def _add_fields(self, table, fields, item):
+        # Appends the value indexes of the fields of a model object to their columns
+        columns = self._columns
+        for field in fields:
+            columns[table + "." + field].append(self._value_index(getattr(item, field),
+                                                                  field not in UNSHARED_FIELDS))
+
+    def _value_index(self, value, shared=True):
+        # Returns the index of a value in the value table, adding it if needed
+        if value is None:
+            return 0
+        if type(value) is str:
+            kind, text = STR_VALUE, value
+        elif type(value) is int:
+            kind, text = INT_VALUE, str(value)
+        else:
+            kind, text = JSON_VALUE, json.dumps(value)
+        if shared:
+            index = self._value_indexes.get((kind, text))
+            if index is not None:
+                return index
+        index = self._length("values.kind")
+        self._data += text.encode("utf-8")
+        self._columns["values.kind"].append(kind)
+        self._columns["values.offset"].append(self._length("values.data"))
+        if shared:
+            self._value_indexes[(kind, text)] = index
+        return index
+
+
+class ParsedConversations:
+    """Conversations stored in a cache file, read straight from the memory mapped file.
+
+    Conversation objects are only built as they are iterated over (or accessed by index), so they can be
+    streamed to TitaniumBackupFormatter without loading the whole cache.
+    """
+
+    def __init__(self, path):
+        """Open a cache file.
+
+        :param path: name of the cache file
+        :raise ValueError: if the file is not a cache file of this version
+        """
+        with open(path, "rb") as cache_file:
+            self._map = mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._views = []
+        try:
+            view = self._view(memoryview(self._map))
+            if bytes(view[:len(MAGIC)]) != MAGIC:
+                raise ValueError("Not a parse cache file")
+            version, header_length = struct.unpack_from("<II", self._map, len(MAGIC))
+            if version != VERSION:
+                raise ValueError("Unsupported parse cache version")
+            header_start = len(MAGIC) + 8
+            header = json.loads(bytes(view[header_start:header_start + header_length]).decode("utf-8"))
+            if header["byteorder"] != sys.byteorder:
+                raise ValueError("Parse cache was written on a machine with a different byte order")
+            self.self_gaia_id = header["self_gaia_id"]
+            start = _aligned(header_start + header_length)
+            self._columns = {}
+            for name, (offset, typecode, length) in header["columns"].items():
+                itemsize = array(typecode).itemsize
+                column = self._view(view[start + offset:start + offset + length * itemsize])
+                self._columns[name] = self._view(column.cast(typecode)) if typecode != "B" else column
+            self._kinds = self._columns["values.kind"]
+            self._offsets = self._columns["values.offset"]
+            self._data = self._columns["values.data"]
+            self._message_columns = tuple(self._columns["messages." + field] for field in MESSAGE_FIELDS)
+            self._shared_values = {}
+        except BaseException:
+            self.close()
+            raise
+
+    def __len__(self):
+        return len(self._columns["conversations.message_start"])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __getitem__(self, index):
+        """Build the Conversation at an index."""
+        columns = self._columns
+        conversation = Conversation()
+        for field, value in self._fields("conversations", CONVERSATION_FIELDS, index).items():
+            setattr(conversation, field, value)
+        participant_count = columns["conversations.participant_count"][index]
+        if participant_count != NO_ITEMS:
+            start = columns["conversations.participant_start"][index]
+            conversation.participants = {}
+            for participant_index in range(start, start + participant_count):
+                participant = Participant()
+                for field, value in self._fields("participants", PARTICIPANT_FIELDS, participant_index).items():
+                    setattr(participant, field, value)
+                conversation.participants[participant.gaia_id] = participant
+        message_count = columns["conversations.message_count"][index]
+        if message_count != NO_ITEMS:
+            start = columns["conversations.message_start"][index]
+            conversation.messages = [self._message(message_index)
+                                     for message_index in range(start, start + message_count)]
+        return conversation
+
+    def close(self):
+        """Release the memory mapped file."""
+        # Views of the map have to be released before it can be closed
+        self._columns = {}
+        self._kinds = self._offsets = self._data = self._message_columns = None
+        while self._views:
+            self._views.pop().release()
+        self._map.close()
+
+    def _view(self, view):
+        # Keeps track of a memoryview of the map
+        self._views.append(view)
+        return view
+
+    def _message(self, index):
+        # Builds the Message at an index
+        columns = self._columns
+        sender_gaia_ids, sender_chat_ids, timestamps, medium_types, event_types, contents = self._message_columns
+        shared_value = self._shared_value
+        message = Message(shared_value(sender_gaia_ids[index]), shared_value(sender_chat_ids[index]),
+                          self._value(timestamps[index]), shared_value(medium_types[index]),
+                          shared_value(event_types[index]), self._value(contents[index]))
+        attachment_count = columns["messages.attachment_count"][index]
+        if attachment_count != NO_ITEMS:
+            start = columns["messages.attachment_start"][index]
+            message.attachments = [Attachment(**self._fields("attachments", ATTACHMENT_FIELDS, attachment_index))
+                                   for attachment_index in range(start, start + attachment_count)]
+        return message
+
+    def _fields(self, table, fields, index):
+        # Returns the values of fields of the item at an index
+        result = {}
+        for field in fields:
+            value_index = self._columns[table + "." + field][index]
+            result[field] = self._value(value_index) if field in UNSHARED_FIELDS else self._shared_value(value_index)
+        return result
+
+    def _shared_value(self, index):
+        # Decodes a value that may repeat, reusing the object decoded before
+        value = self._shared_values.get(index)
+        if value is None and index != 0:
+            value = self._shared_values[index] = self._value(index)
+        return value
+
+    def _value(self, index):
+        # Decodes a value of the value table
+        kind = self._kinds[index]
+        if kind == NONE_VALUE:
+            return None
+        text = str(self._data[self._offsets[index]:self._offsets[index + 1]], "utf-8")
+        if kind == STR_VALUE:
+            return text
+        if kind == INT_VALUE:
+            return int(text)
+        return json.loads(text)
+
+
+def file_key(file_name, *options):
+    """Return a key identifying the contents of a file together with options applied to it.
+
+    :param file_name: name of the file
+    :param options: values (e.g. settings) that are part of the key
+    :return: hex string
+    """
+    status = os.stat(file_name)
+    digest = hashlib.sha256(_file_digest(os.path.abspath(file_name), status.st_size, status.st_mtime_ns))
+    digest.update(repr(options).encode("utf-8"))
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=16)
+def _file_digest(file_name, size, mtime):
+    # Returns the SHA-256 of a file; the size and modification time make a changed file hash again
+    digest = hashlib.sha256()
+    with open(file_name, "rb") as input_file:
+        while True:
+            chunk = input_file.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.digest()
+
+
+def _aligned(offset):
+    # Rounds an offset up to the column alignment
+    return (offset + COLUMN_ALIGNMENT - 1) // COLUMN_ALIGNMENT * COLUMN_ALIGNMENT
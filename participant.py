@@ -3,16 +3,18 @@ class Participant:
 
     Model that describes a person in a conversation.
     """
-    name = None
-    gaia_id = None
-    chat_id = None  # Not used
-    type = None  # Not used
-    e164_number = None
-    country_code = None  # Not used
-    international_number = None
-    national_number = None
-    region_code = None  # Not used
-    latest_read_timestamp = None  # Not used
+    __slots__ = (
+        "name",
+        "gaia_id",
+        "chat_id",  # Not used
+        "type",  # Not used
+        "e164_number",
+        "country_code",  # Not used
+        "international_number",
+        "national_number",
+        "region_code",  # Not used
+        "latest_read_timestamp",  # Not used
+    )
 
     def __init__(self, name=None, gaia_id=None, chat_id=None, type=None, e164_number=None, country_code=None,
                  international_number=None, national_number=None, region_code=None, latest_timestamp=None):
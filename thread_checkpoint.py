@@ -0,0 +1,111 @@
+import hashlib
+import os
+import shutil
+from contextlib import contextmanager
+
+
+LOG_FILE_NAME = "completed.log"
+KEY_FILE_NAME = "key"
+THREADS_DIRECTORY = "threads"
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class ThreadCheckpoint:
+    """Records which threads of a conversion have been written, so an interrupted conversion can resume.
+
+    Every thread is rendered to its own fragment file in a staging directory, and once the fragment is
+    complete the conversation ID is appended to a log. A restarted conversion copies the fragments of
+    completed threads into the output instead of rendering them (and downloading their attachments) again.
+    A checkpoint is only reused by a conversion with the same key, so threads rendered from another input
+    file or with other settings are never mixed in.
+    """
+
+    def __init__(self, directory, key=None):
+        """Open (or create) a checkpoint.
+
+        :param directory: staging directory for the checkpoint
+        :param key: optional string identifying the input and settings of the conversion (e.g. from
+                    parse_cache.file_key); a checkpoint left by a conversion with another key is discarded
+        """
+        self.directory = directory
+        if key is not None and self._stored_key() != key:
+            shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(os.path.join(directory, THREADS_DIRECTORY), exist_ok=True)
+        if key is not None:
+            key_path = os.path.join(directory, KEY_FILE_NAME)
+            with open(key_path + ".tmp", "w", encoding="utf-8") as key_file:
+                key_file.write(key)
+            os.replace(key_path + ".tmp", key_path)
+        self._completed = set()
+        try:
+            with open(os.path.join(directory, LOG_FILE_NAME), encoding="utf-8") as log_file:
+                for line in log_file:
+                    # An interrupted run may have left a partial last line
+                    if line.endswith("\n") and os.path.exists(self._fragment_path(line[:-1])):
+                        self._completed.add(line[:-1])
+        except OSError:
+            pass
+        self._log = open(os.path.join(directory, LOG_FILE_NAME), "a", encoding="utf-8")
+
+    def is_completed(self, conversation_id):
+        """Return True if the thread of a conversation has already been written."""
+        return conversation_id in self._completed
+
+    @contextmanager
+    def stage(self, conversation_id):
+        """Context manager giving a binary file to write the thread of a conversation to.
+
+        The thread is marked as completed when the block finishes without an exception.
+
+        :param conversation_id: ID of the conversation
+        """
+        path = self._fragment_path(conversation_id)
+        with open(path + ".tmp", "wb") as fragment_file:
+            try:
+                yield fragment_file
+            except BaseException:
+                fragment_file.close()
+                os.remove(path + ".tmp")
+                raise
+            fragment_file.flush()
+            os.fsync(fragment_file.fileno())
+        os.replace(path + ".tmp", path)
+        self._log.write(conversation_id + "\n")
+        self._log.flush()
+        self._completed.add(conversation_id)
+
+    def store(self, conversation_id, data):
+        """Store the already rendered thread of a conversation.
+
+        :param conversation_id: ID of the conversation
+        :param data: UTF-8 encoded thread element
+        """
+        with self.stage(conversation_id) as fragment_file:
+            fragment_file.write(data)
+
+    def copy_thread(self, conversation_id, sms_output):
+        """Copy the stored thread of a completed conversation into the output.
+
+        :param conversation_id: ID of the conversation
+        :param sms_output: BufferedXmlWriter of the output file
+        """
+        with open(self._fragment_path(conversation_id), "rb") as fragment_file:
+            sms_output.write_rendered_thread(iter(lambda: fragment_file.read(COPY_CHUNK_SIZE), b""))
+
+    def remove(self):
+        """Delete the checkpoint once the conversion has finished."""
+        self._log.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _stored_key(self):
+        # Returns the key the checkpoint was created with, or None
+        try:
+            with open(os.path.join(self.directory, KEY_FILE_NAME), encoding="utf-8") as key_file:
+                return key_file.read()
+        except OSError:
+            return None
+
+    def _fragment_path(self, conversation_id):
+        # Conversation IDs are hashed so they are always safe file names
+        file_name = hashlib.sha1(conversation_id.encode("utf-8")).hexdigest() + ".xml"
+        return os.path.join(self.directory, THREADS_DIRECTORY, file_name)
@@ -1,199 +1,588 @@
-import urllib.request
 import base64
-import uuid
+import hashlib
+import io
+import multiprocessing
 import os
-from datetime import datetime
-from xml.sax.saxutils import escape
+import re
+import tempfile
+from binascii import b2a_base64
+from collections import deque
+from datetime import date, datetime
+from functools import lru_cache
+from xml.sax.saxutils import unescape
+from attachment_downloader import AttachmentDownloader, FetchedAttachments
+from xml_writer import BufferedXmlWriter, ShardedXmlWriter
+from thread_checkpoint import ThreadCheckpoint
+from attachment_payloads import AttachmentPayloads
+from metrics import ConversionMetrics
+from titanium_index import SELF_SENDER
+from conversation import Conversation
 
 
 # XML output constants for Titanium Backup
 SMS_OUTPUT_HEADER_1 = "<?xml version=\'1.0\' encoding=\'UTF-8\' standalone=\'yes\' ?>"
 SMS_OUTPUT_HEADER_2 = "<threads count=\"{}\" xmlns=\"http://www.titaniumtrack.com/ns/titanium-backup/messages\">"
+SMS_OUTPUT_HEADER_2_PADDED = "<threads count=\"{}\"{} xmlns=\"http://www.titaniumtrack.com/ns/titanium-backup/messages\">"
+THREAD_COUNT_WIDTH = 20
 MMS_PART = "<part contentType=\"{}\" order=\"{}\" name=\"part-0\" encoding=\"{}\">{}</part>"
+MMS_PART_START = "<part contentType=\"{}\" order=\"{}\" name=\"part-0\" encoding=\"{}\">"
+MMS_PART_END = "</part>"
+# Content types of the attachment media types that are downloaded and embedded
+MMS_CONTENT_TYPES = {"PHOTO": "image/jpeg", "ANIMATED_PHOTO": "image/gif", "VIDEO": "video/*"}
+MMS_MEDIA_TYPES = tuple(MMS_CONTENT_TYPES)
+# Start of SMS elements, up to the date
+SMS_SENT_START = "<sms msgBox=\"sent\" date=\""
+SMS_INBOX_START = "<sms msgBox=\"inbox\" date=\""
+# Start of MMS elements, up to the addresses
+# always assume 'locked' = false
+# TODO: seen
+# TODO: read
+MMS_SENT_START = ("<mms msgBox=\"sent\" version=\"1.2\" type=\"sendReq\""
+                  " contentType=\"application/vnd.wap.multipart.related\""
+                  " date=\"{0}\" locked=\"false\" seen=\"false\" read=\"true\">")
+MMS_INBOX_START = ("<mms msgBox=\"inbox\" version=\"1.2\" type=\"retrieveConf\""
+                   " contentType=\"application/vnd.wap.multipart.related\""
+                   " date=\"{0}\" dateSent=\"{0}\" locked=\"false\" seen=\"false\" read=\"true\">")
+# Timestamps are converted with integer arithmetic below this limit (the year 2106), where converting them
+# to float seconds for datetime is exact to the microsecond; others fall back to datetime
+FAST_TIMESTAMP_LIMIT = 2 ** 32 * 1000000
+MICROSECONDS_PER_DAY = 24 * 60 * 60 * 1000000
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+# Tags found when adding new messages to a previous output file
+MERGE_TAGS = re.compile(rb"<threads\b[^>]*>|<thread\b[^>]*>|</thread>|</threads>")
+THREAD_ADDRESS = re.compile(rb"\saddress=\"([^\"]*)\"")
+MERGE_CHUNK_SIZE = 1024 * 1024
+# Size of the pieces attachments are read and base64 encoded in
+BASE64_CHUNK_SIZE = 3 * 64 * 1024
+
+
+@lru_cache(maxsize=4096)
+def _utc_date_string(days):
+    # Returns the date that is a number of days after the Unix epoch
+    return date.fromordinal(EPOCH_ORDINAL + days).isoformat()
 
 
 class TitaniumBackupFormatter:
     """Converts parsed Hangouts SMS/MMS messages from HangoutsParser for use with Titanium Backup"""
 
-    def create_output_file(self, conversations, self_gaia_id, output_file_name):
+    def __init__(self, downloader=None, prefetch_depth=4, processes=1, buffer_size=BufferedXmlWriter.BUFFER_SIZE,
+                 payloads=None, metrics=None, max_file_bytes=None, max_file_messages=None):
+        """Create a formatter.
+
+        :param downloader: AttachmentDownloader used to fetch MMS attachments
+        :param prefetch_depth: number of conversations whose attachments are downloaded ahead of the one being written
+        :param processes: number of worker processes rendering threads in parallel (1 renders in this process)
+        :param buffer_size: number of characters of output collected before they are written to the file
+        :param payloads: AttachmentPayloads used to reuse attachments that recur (a new one by default)
+        :param metrics: ConversionMetrics the rendering stages, counts, errors and progress are recorded in
+        :param max_file_bytes: optional size in bytes after which create_output_file continues in a new file
+        :param max_file_messages: optional number of messages after which create_output_file continues in a new file
+        """
+        self.downloader = downloader if downloader is not None else AttachmentDownloader()
+        self.prefetch_depth = prefetch_depth
+        self.processes = processes
+        self.buffer_size = buffer_size
+        self.payloads = payloads if payloads is not None else AttachmentPayloads()
+        self.metrics = metrics if metrics is not None else ConversionMetrics()
+        self.max_file_bytes = max_file_bytes
+        self.max_file_messages = max_file_messages
+
+    def create_output_file(self, conversations, self_gaia_id, output_file_name, checkpoint_directory=None,
+                           checkpoint_key=None):
         """Creates an XML file containing SMS/MMS that can be used in Titanium Backup.
 
-        :param conversations: list of Conversation objects
-        :param self_gaia_id: GAIA ID of the user
+        Conversations may be given as a list or as any iterable, such as the generator returned by
+        HangoutsParser.iter_conversations. Each thread is written as soon as its conversation is consumed;
+        when the number of conversations is not known up front, the thread count in the header is
+        written as a fixed-width placeholder and filled in once all conversations have been written.
+
+        With a checkpoint directory, every thread is also kept there as it is completed. If the conversion
+        is interrupted, running it again with the same directory reuses the completed threads instead of
+        rendering them again; the directory is removed once the output file is complete. Give a checkpoint
+        key identifying the input and settings, so a checkpoint left by a different conversion is discarded.
+
+        :param conversations: list or iterable of Conversation objects
+        :param self_gaia_id: GAIA ID of the user, or None to use the ID recorded on each Conversation
         :param output_file_name: name of the output XML file
-        :return:
+        :param checkpoint_directory: optional staging directory for resuming interrupted conversions
+        :param checkpoint_key: optional key of the conversion (e.g. from parse_cache.file_key)
+        :return: list of the names of the files written
         """
+        total = len(conversations) if hasattr(conversations, "__len__") else None
+        checkpoint = ThreadCheckpoint(checkpoint_directory, checkpoint_key) if checkpoint_directory is not None \
+            else None
+        if self.max_file_bytes is not None or self.max_file_messages is not None:
+            file_names = self._write_sharded_files(conversations, self_gaia_id, output_file_name, total, checkpoint)
+        else:
+            file_names = [output_file_name]
+            try:
+                os.remove(output_file_name)
+            except OSError:
+                pass
+            with open(output_file_name, 'wb') as output_file:
+                sms_output = BufferedXmlWriter(output_file, self.buffer_size, self.metrics)
+                sms_output.write(SMS_OUTPUT_HEADER_1)
+                if total is not None:
+                    header_position = None
+                    sms_output.write(SMS_OUTPUT_HEADER_2.format(total))
+                else:
+                    header_position = sms_output.tell()
+                    sms_output.write(self._padded_threads_header(0))
+                conversations = _CountingIterator(conversations, self.metrics, total)
+                self._write_threads(sms_output, conversations, self_gaia_id, checkpoint)
+                sms_output.write("</threads>")
+                if header_position is not None:
+                    # Back-patch the real thread count over the placeholder
+                    sms_output.seek(header_position)
+                    sms_output.write(self._padded_threads_header(conversations.count))
+                sms_output.flush()
+                self.metrics.count("bytes_written", sms_output.bytes_written)
+        self.metrics.finish_progress()
+        if checkpoint is not None:
+            checkpoint.remove()
+        return file_names
+
+    def _write_sharded_files(self, conversations, self_gaia_id, output_file_name, total, checkpoint):
+        # Writes the threads over numbered files that each stay within max_file_bytes and max_file_messages
+        # Returns the names of the files
+        sms_output = ShardedXmlWriter(output_file_name, self._file_header, "</threads>", self.max_file_bytes,
+                                      self.max_file_messages, self.buffer_size, self.metrics)
         try:
-            os.remove(output_file_name)
-        except OSError:
-            pass
-        with open(output_file_name, 'w') as sms_output:
-            sms_output.write(SMS_OUTPUT_HEADER_1)
-            sms_output.write(SMS_OUTPUT_HEADER_2.format(len(conversations)))
-            for conversation in conversations:
-                # Skip non-SMS conversations
+            self._write_threads(sms_output, _CountingIterator(conversations, self.metrics, total), self_gaia_id,
+                                checkpoint)
+        finally:
+            sms_output.close()
+        self.metrics.count("bytes_written", sms_output.bytes_written)
+        return sms_output.file_names
+
+    def _write_threads(self, sms_output, conversations, self_gaia_id, checkpoint):
+        # Writes the thread elements of all conversations, in this process or in worker processes
+        if self.processes > 1:
+            self._write_threads_in_processes(sms_output, conversations, self_gaia_id, checkpoint)
+        else:
+            for conversation in self._prefetched(conversations, checkpoint):
+                conversation_self_gaia_id = self_gaia_id if self_gaia_id is not None \
+                    else conversation.self_gaia_id
+                if self._is_checkpointed(conversation, checkpoint):
+                    self._write_checkpointed_thread(sms_output, conversation, conversation_self_gaia_id,
+                                                    checkpoint)
+                else:
+                    self._write_thread(sms_output, conversation, conversation_self_gaia_id)
+                self._discard_attachments(conversation)
+        self.downloader.close()
+
+    def create_delta_file(self, conversations, self_gaia_id, output_file_name, index, previous_file_name=None):
+        """Creates an XML file with the messages that are newer than those of a previous conversion.
+
+        Messages are compared with an index of the previous output (see TitaniumBackupIndex). Given the
+        previous output file itself, the result is that file with the new messages added to the end of
+        their threads and threads that did not exist before added at the end; otherwise the result only
+        contains the new messages.
+
+        :param conversations: list or iterable of Conversation objects
+        :param self_gaia_id: GAIA ID of the user, or None to use the ID recorded on each Conversation
+        :param output_file_name: name of the output XML file (may be the same as the previous file)
+        :param index: TitaniumBackupIndex of the previous output
+        :param previous_file_name: optional previous output XML file to add the new messages to
+        :return:
+        """
+        # The new messages are rendered first, since they have to be placed into the previous threads
+        # They are staged in one file per thread address, so embedded attachments are not kept in memory
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_file_name))) as staging:
+            new_threads = {}  # address -> staged fragment file
+            for conversation in self._prefetched(self._new_conversations(conversations, self_gaia_id, index)):
+                context = _ThreadContext(self, conversation, conversation.self_gaia_id)
+                address = "{}".format(context.address)
+                fragment_name = new_threads.get(address)
+                if fragment_name is None:
+                    fragment_name = new_threads[address] = os.path.join(
+                        staging, hashlib.sha1(address.encode("utf-8")).hexdigest() + ".xml")
+                with open(fragment_name, "ab") as fragment_file:
+                    fragment_output = BufferedXmlWriter(fragment_file, self.buffer_size)
+                    self._write_messages(fragment_output, conversation, conversation.self_gaia_id, context,
+                                         conversation.messages)
+                    fragment_output.flush()
+                self._discard_attachments(conversation)
+            self.downloader.close()
+            # Write to a temporary file, so the previous file can also be the output file
+            temp_file_name = output_file_name + ".tmp"
+            with open(temp_file_name, 'wb') as output_file:
+                sms_output = BufferedXmlWriter(output_file, self.buffer_size, self.metrics)
+                if previous_file_name is not None:
+                    self._merge_previous_file(sms_output, previous_file_name, new_threads)
+                else:
+                    sms_output.write(SMS_OUTPUT_HEADER_1)
+                    sms_output.write(SMS_OUTPUT_HEADER_2.format(len(new_threads)))
+                    self._write_new_threads(sms_output, new_threads)
+                    sms_output.write("</threads>")
+                sms_output.flush()
+                self.metrics.count("bytes_written", sms_output.bytes_written)
+        os.replace(temp_file_name, output_file_name)
+
+    def _new_conversations(self, conversations, self_gaia_id, index):
+        # Yields copies of the SMS conversations that only have their messages that are not in the index
+        for conversation in conversations:
+            if "PHONE" not in conversation.network_types or not conversation.messages:
+                continue
+            conversation_self_gaia_id = self_gaia_id if self_gaia_id is not None else conversation.self_gaia_id
+            context = _ThreadContext(self, conversation, conversation_self_gaia_id)
+            address = "{}".format(context.address)
+            new_messages = []
+            for message in conversation.messages:
+                if type(message.timestamp) is not int:
+                    continue
+                if message.sender_gaia_id == conversation_self_gaia_id:
+                    sender = SELF_SENDER
+                elif message.sender_gaia_id in conversation.participants:
+                    sender = self._get_participant_phone_number(conversation.participants[message.sender_gaia_id])
+                else:
+                    sender = None
+                if index.is_new(address, message.timestamp // 1000, sender):
+                    new_messages.append(message)
+            if new_messages:
+                yield Conversation(network_types=conversation.network_types,
+                                   participants=conversation.participants,
+                                   active_timestamp=conversation.active_timestamp,
+                                   messages=new_messages,
+                                   self_gaia_id=conversation_self_gaia_id,
+                                   conversation_id=conversation.conversation_id)
+
+    def _merge_previous_file(self, sms_output, previous_file_name, new_threads):
+        # Copies the previous file, adding the new messages to the end of their threads
+        # and the threads that are not in the previous file to the end
+        header_position = None
+        thread_count = 0
+        address = None
+        with open(previous_file_name, 'rb') as previous_file:
+            buffer = b""
+            end_of_file = False
+            while True:
+                match = MERGE_TAGS.search(buffer)
+                if match is None:
+                    if end_of_file:
+                        sms_output.write_bytes(buffer)
+                        break
+                    # Hold back a tag that may continue in the next chunk
+                    keep = buffer.rfind(b"<")
+                    if keep < 0:
+                        keep = len(buffer)
+                    sms_output.write_bytes(buffer[:keep])
+                    chunk = previous_file.read(MERGE_CHUNK_SIZE)
+                    end_of_file = not chunk
+                    buffer = buffer[keep:] + chunk
+                    continue
+                sms_output.write_bytes(buffer[:match.start()])
+                tag = match.group()
+                buffer = buffer[match.end():]
+                if tag.startswith(b"<threads"):
+                    header_position = sms_output.tell()
+                    sms_output.write(self._padded_threads_header(0))
+                elif tag.startswith(b"<thread"):
+                    thread_count += 1
+                    address_match = THREAD_ADDRESS.search(tag)
+                    address = unescape(address_match.group(1).decode("utf-8")) if address_match else None
+                    sms_output.write_bytes(tag)
+                elif tag == b"</thread>":
+                    if address in new_threads:
+                        self._copy_fragment(sms_output, new_threads.pop(address))
+                    sms_output.write_bytes(tag)
+                else:
+                    thread_count += len(new_threads)
+                    self._write_new_threads(sms_output, new_threads)
+                    new_threads.clear()
+                    sms_output.write_bytes(tag)
+        if header_position is not None:
+            # Back-patch the real thread count over the placeholder
+            sms_output.seek(header_position)
+            sms_output.write(self._padded_threads_header(thread_count))
+
+    @staticmethod
+    def _write_new_threads(sms_output, new_threads):
+        # Writes thread elements around staged fragments of rendered messages
+        for address, fragment_name in new_threads.items():
+            sms_output.start_thread(address)
+            TitaniumBackupFormatter._copy_fragment(sms_output, fragment_name)
+            sms_output.end_thread()
+
+    @staticmethod
+    def _copy_fragment(sms_output, fragment_name):
+        # Copies a staged fragment file into the output a chunk at a time
+        with open(fragment_name, "rb") as fragment_file:
+            while True:
+                chunk = fragment_file.read(MERGE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                sms_output.write_bytes(chunk)
+
+    @staticmethod
+    def _is_checkpointed(conversation, checkpoint):
+        # Returns True if the thread of a conversation is kept in the checkpoint
+        return checkpoint is not None and conversation.conversation_id is not None \
+            and "PHONE" in conversation.network_types
+
+    def _write_checkpointed_thread(self, sms_output, conversation, self_gaia_id, checkpoint):
+        # Renders a thread into the checkpoint unless it is already there, then copies it to the output
+        if not checkpoint.is_completed(conversation.conversation_id):
+            with checkpoint.stage(conversation.conversation_id) as fragment_file:
+                fragment_output = BufferedXmlWriter(fragment_file, self.buffer_size)
+                self._write_thread(fragment_output, conversation, self_gaia_id)
+                fragment_output.flush()
+        checkpoint.copy_thread(conversation.conversation_id, sms_output)
+
+    def _write_threads_in_processes(self, sms_output, conversations, self_gaia_id, checkpoint):
+        # Renders threads in a pool of worker processes and writes them in their original order
+        # Attachments are still downloaded by this process; workers only read the downloaded data
+        with multiprocessing.Pool(self.processes) as pool:
+            rendering = deque()
+            for conversation in self._prefetched(conversations, checkpoint):
                 if "PHONE" not in conversation.network_types:
                     continue
-                sms_output.write("<thread address=\"{}\">".format(
-                    self._create_participant_string(conversation.participants, self_gaia_id)))
-                for message in conversation.messages:
-                    if message.sender_gaia_id is None:
-                        print("Error: message sender gaia ID is None!")
-                        continue
-                    if message.sender_gaia_id not in conversation.participants.keys():
-                        print("Error: could not match sender gaia ID to participant IDs!")
-                        continue
-                    is_sms = len(conversation.participants) <= 2 and message.attachments is None
-                    is_sent = message.sender_gaia_id == self_gaia_id
-                    message_timestamp = self._timestamp_to_utc_string(message.timestamp)
-                    if is_sms:
-                        # Store the other participant in the SMS conversation
-                        non_self_participant = None
-                        for participant in conversation.participants.values():
-                            if participant.gaia_id != self_gaia_id:
-                                non_self_participant = participant
-                                break
-                        # start of sms
-                        message_string = "<sms msgBox=\"{}\"".format("sent" if is_sent else "inbox")
-                        # 'sent' messages only have 'date' field
-                        # 'inbox' messages have 'date' and 'dateSent' fields
-                        message_string += " date=\"{}\"".format(message_timestamp)
-                        if not is_sent:
-                            message_string += " dateSent=\"{}\"".format(message_timestamp)
-                        # always assume 'locked' = false
-                        message_string += " locked=\"false\""
-
-                        # TODO: seen
-                        # TODO: read
-                        message_string += " seen=\"false\" read=\"true\""
-
-                        # address is always the number of the other person in an SMS conversation
-                        message_string += " address=\"{}\"".format(
-                            self._get_participant_phone_number(non_self_participant))
-                        # plain or base64
-                        content_is_plain = self._is_ascii(message.content)
-                        # content
-                        if message.content is not None:
-                            message_string += " encoding=\"{}\"".format("plain" if content_is_plain else "base64")
-                        message_string += ">{}".format(
-                            escape(message.content) if content_is_plain
-                            else self._base64_text(message.content))
-                        message_string += "</sms>"
-                        sms_output.write(message_string)
-                    else:
-                        # start of mms
-                        message_string = "<mms msgBox=\"{}\" version=\"1.2\"".format("sent" if is_sent else "inbox")
-                        # type
-                        message_string += " type=\"{}\"".format("sendReq" if is_sent else "retrieveConf")
-                        # content type is fixed..?
-                        message_string += " contentType=\"application/vnd.wap.multipart.related\""
-                        # 'sent' messages only have 'date' field
-                        # 'inbox' messages have 'date' and 'dateSent' fields
-                        message_string += " date=\"{}\"".format(message_timestamp)
-                        if not is_sent:
-                            message_string += " dateSent=\"{}\"".format(message_timestamp)
-                        # always assume 'locked' = false
-                        message_string += " locked=\"false\""
-
-                        # TODO: seen
-                        # TODO: read
-                        message_string += " seen=\"false\" read=\"true\">"
-
-                        # addresses
-                        message_string += "<addresses>"
-                        if is_sent:
-                            message_string += "<address type=\"from\">insert-address-token</address>"
-                        else:
-                            sender = conversation.participants[message.sender_gaia_id]
-                            message_string += "<address type=\"from\">{}</address>".format(
-                                self._get_participant_phone_number(sender))
-                        # Store the other participants
-                        for participant in conversation.participants.values():
-                            if participant.gaia_id != self_gaia_id and participant.gaia_id != message.sender_gaia_id:
-                                message_string += "<address type=\"{}\">{}</address>".format(
-                                    "from" if participant.gaia_id == message.sender_gaia_id else "to",
-                                    self._get_participant_phone_number(participant))
-                        message_string += "</addresses>"
-
-                        # parts
-                        order = 0
-                        if message.content is not None:
-                            content_is_plain = self._is_ascii(message.content)
-                            message_string += MMS_PART.format("text/plain",
-                                                              order,
-                                                              "plain" if content_is_plain
-                                                              else "base64",
-                                                              escape(message.content) if content_is_plain
-                                                              else self._base64_text(message.content))
-                            order += 1
-                        if message.attachments is not None and len(message.attachments) > 0:
-                            for attachment in message.attachments:
-                                if attachment.media_type is not None:
-                                    if attachment.media_type == "PHOTO":
-                                        data = None
-                                        if attachment.original_content_url is not None:
-                                            data = self._convert_url_to_base64_data(attachment.original_content_url)
-                                        if data is not None:
-                                            message_string += MMS_PART.format("image/jpeg", order, "base64", data)
-                                            order += 1
-                                        else:
-                                            print("Error: unable to download image data!")
-                                    elif attachment.media_type == "ANIMATED_PHOTO":
-                                        data = None
-                                        if attachment.original_content_url is not None:
-                                            data = self._convert_url_to_base64_data(attachment.original_content_url)
-                                        if data is not None:
-                                            message_string += MMS_PART.format("image/gif", order, "base64", data)
-                                            order += 1
-                                        else:
-                                            print("Error: unable to download image data!")
-                                    elif attachment.media_type == "VIDEO":
-                                        data = None
-                                        if attachment.original_content_url is not None:
-                                            data = self._convert_url_to_base64_data(attachment.original_content_url)
-                                        if data is not None:
-                                            message_string += MMS_PART.format("video/*", order, "base64", data)
-                                            order += 1
-                                        else:
-                                            print("Error: unable to download video data!")
-                                    else:
-                                        print("Error: Attachment media type is unknown!")
-                                else:
-                                    print("Error: Attachment media type is unspecified!")
-                        message_string += "</mms>"
-                        sms_output.write(message_string)
+                if self._is_checkpointed(conversation, checkpoint) \
+                        and checkpoint.is_completed(conversation.conversation_id):
+                    rendering.append((conversation, None))
+                    continue
+                downloads = {attachment.original_content_url:
+                             self.downloader.result(attachment.original_content_url)
+                             for attachment in self._embedded_attachments(conversation)}
+                rendering.append((conversation, pool.apply_async(
+                    _render_thread,
+                    (conversation, self_gaia_id if self_gaia_id is not None else conversation.self_gaia_id,
+                     downloads))))
+                # Bound the number of conversations held in memory while waiting for workers
+                while len(rendering) > 2 * self.processes:
+                    self._write_rendered_thread(sms_output, checkpoint, *rendering.popleft())
+            while rendering:
+                self._write_rendered_thread(sms_output, checkpoint, *rendering.popleft())
 
-                sms_output.write("</thread>")
-            sms_output.write("</threads>")
-            sms_output.close()
+    def _write_rendered_thread(self, sms_output, checkpoint, conversation, result):
+        # Writes a thread rendered by a worker process, or copies it from the checkpoint if it was already done
+        if result is None:
+            checkpoint.copy_thread(conversation.conversation_id, sms_output)
+            return
+        data, worker_metrics = result.get()
+        self.metrics.merge(worker_metrics)
+        if self._is_checkpointed(conversation, checkpoint):
+            checkpoint.store(conversation.conversation_id, data)
+        sms_output.write_rendered_thread((data,))
+        self._discard_attachments(conversation)
+
+    def _prefetched(self, conversations, checkpoint=None):
+        # Yields the conversations, downloading the attachments of upcoming ones in the background
+        # Attachments of threads that are already in the checkpoint are not needed
+        pending = deque()
+        for conversation in conversations:
+            if not (self._is_checkpointed(conversation, checkpoint)
+                    and checkpoint.is_completed(conversation.conversation_id)):
+                self.prefetch_attachments(conversation)
+            pending.append(conversation)
+            if len(pending) > self.prefetch_depth:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+
+    def _discard_attachments(self, conversation):
+        # Releases the downloaded data of a conversation that has been written
+        self.downloader.discard(attachment.original_content_url
+                                for attachment in self._embedded_attachments(conversation))
+
+    @staticmethod
+    def _embedded_attachments(conversation):
+        # Returns all attachments that will be downloaded and embedded for a conversation
+        if "PHONE" not in conversation.network_types or conversation.messages is None:
+            return []
+        return [attachment for message in conversation.messages if message.attachments is not None
+                for attachment in message.attachments
+                if attachment.media_type in MMS_MEDIA_TYPES and attachment.original_content_url is not None]
+
+    def prefetch_attachments(self, conversation):
+        """Start downloading the attachments of a conversation in the background.
+
+        Attachments already written earlier are reused instead of downloaded.
+
+        :param conversation: Conversation that will be written
+        :return: list of the concurrent.futures.Future of the downloads
+        """
+        urls = []
+        aliases = {}
+        for attachment in self._embedded_attachments(conversation):
+            keys = self._attachment_keys(attachment)
+            if not self.payloads.contains(*keys):
+                urls.append(keys[0])
+                aliases[keys[0]] = keys[1:]
+        return self.downloader.prefetch(urls, aliases)
+
+    @staticmethod
+    def _attachment_keys(attachment):
+        # Returns the URL of an attachment followed by the other keys it is known by
+        if attachment.photo_id is not None:
+            return attachment.original_content_url, "photo:{}:{}".format(attachment.album_id, attachment.photo_id)
+        return attachment.original_content_url,
+
+    def _write_thread(self, sms_output, conversation, self_gaia_id):
+        # Writes the thread element for a single conversation
+        # Skip non-SMS conversations
+        if "PHONE" not in conversation.network_types:
+            return
+        with self.metrics.timer("render"):
+            context = _ThreadContext(self, conversation, self_gaia_id)
+            sms_output.start_thread(context.address)
+            self._write_messages(sms_output, conversation, self_gaia_id, context, conversation.messages)
+            sms_output.end_thread()
+        self.metrics.count("threads_written")
+
+    def _write_messages(self, sms_output, conversation, self_gaia_id, context, messages):
+        # Writes the sms/mms elements for messages of a conversation
+        write = sms_output.append
+        written = 0
+        for message, body in zip(messages, self._encode_bodies(messages)):
+            if message.sender_gaia_id is None:
+                self.metrics.error("sender", "Error: message sender gaia ID is None!")
+                continue
+            if message.sender_gaia_id not in conversation.participants:
+                self.metrics.error("sender", "Error: could not match sender gaia ID to participant IDs!")
+                continue
+            written += 1
+            sms_output.start_message()
+            is_sms = not context.is_group and message.attachments is None
+            is_sent = message.sender_gaia_id == self_gaia_id
+            message_timestamp = self._timestamp_to_utc_string(message.timestamp)
+            if is_sms:
+                # start of sms
+                # 'sent' messages only have 'date' field
+                # 'inbox' messages have 'date' and 'dateSent' fields
+                write(SMS_SENT_START if is_sent else SMS_INBOX_START)
+                write(message_timestamp)
+                if not is_sent:
+                    write("\" dateSent=\"")
+                    write(message_timestamp)
+                write("\"")
+                # locked, seen, read and the address of the other person
+                write(context.sms_attributes)
+                # plain or base64 content
+                if body is not None:
+                    encoding, text = body
+                    write(" encoding=\"plain\">" if encoding == "plain" else " encoding=\"base64\">")
+                    write(text)
+                else:
+                    write(">")
+                write("</sms>")
+                sms_output.check()
+            else:
+                # start of mms
+                # 'sent' messages only have 'date' field
+                # 'inbox' messages have 'date' and 'dateSent' fields
+                write(MMS_SENT_START.format(message_timestamp) if is_sent
+                      else MMS_INBOX_START.format(message_timestamp))
+
+                # addresses
+                write(context.mms_addresses(message.sender_gaia_id))
+
+                # parts
+                order = 0
+                if body is not None:
+                    encoding, text = body
+                    write(MMS_PART.format("text/plain", order, encoding, text))
+                    order += 1
+                if message.attachments is not None and len(message.attachments) > 0:
+                    for attachment in message.attachments:
+                        if attachment.media_type is not None:
+                            if attachment.media_type in MMS_MEDIA_TYPES:
+                                data_written = False
+                                if attachment.original_content_url is not None:
+                                    data_written = self._write_base64_attachment(
+                                        sms_output, self._attachment_keys(attachment),
+                                        MMS_CONTENT_TYPES[attachment.media_type], order)
+                                if data_written:
+                                    order += 1
+                                elif attachment.media_type == "VIDEO":
+                                    self.metrics.error("attachment_download", "Error: unable to download video data!")
+                                else:
+                                    self.metrics.error("attachment_download", "Error: unable to download image data!")
+                            else:
+                                self.metrics.error("attachment_type", "Error: Attachment media type is unknown!")
+                        else:
+                            self.metrics.error("attachment_type", "Error: Attachment media type is unspecified!")
+                write("</mms>")
+                sms_output.check()
+        self.metrics.count("messages_written", written)
 
     @staticmethod
-    def _is_ascii(text):
-        # Returns true if the text only contains ASCII characters
-        return len(text) == len(text.encode())
+    def _file_header(thread_count):
+        # Returns the start of an output file, with a thread count placeholder that can be overwritten
+        return SMS_OUTPUT_HEADER_1 + TitaniumBackupFormatter._padded_threads_header(thread_count)
 
     @staticmethod
-    def _base64_text(text):
-        # Converts the unicode text to base64
-        return base64.b64encode(bytes(text, "utf-8")).decode('utf-8')
+    def _padded_threads_header(thread_count):
+        # Threads header padded with whitespace to a fixed width, so the count can be rewritten in place
+        count = str(thread_count)
+        return SMS_OUTPUT_HEADER_2_PADDED.format(count, " " * (THREAD_COUNT_WIDTH - len(count)))
 
     @staticmethod
-    def _convert_url_to_base64_data(url):
-        # Downloads a file and converts it to base64
-        encoded_data = None
-        if url is not None:
-            file_name = 'tmp/' + str(uuid.uuid4())
-            os.makedirs(os.path.dirname(file_name), exist_ok=True)
-            with urllib.request.urlopen(url) as file:
-                data = file.read()
-                with open(file_name, "wb") as new_file:
-                    new_file.write(data)
-                    new_file.close()
-                    encoded_data = base64.b64encode(open(file_name, "rb").read()).decode('utf-8')
-                    os.remove(file_name)
-        if encoded_data is None or len(encoded_data) <= 0:
-            print("Error downloading or base64 encoding attachment!")
-        return encoded_data
+    def _encode_body(text):
+        # Returns the encoding ("plain" or "base64") and the encoded form of a message body
+        # ASCII text is XML escaped and anything else is base64 encoded UTF-8; str.isascii() does not copy the
+        # text, so it is only converted to UTF-8 (and only once) when it has to be base64 encoded
+        if text.isascii():
+            return "plain", text.replace("&", "&amp;").replace(">", "&gt;").replace("<", "&lt;")
+        return "base64", b2a_base64(text.encode("utf-8"), newline=False).decode("ascii")
+
+    @classmethod
+    def _encode_bodies(cls, messages):
+        # Encodes the bodies of a batch of messages, such as all messages of a conversation
+        # Returns a list with the result of _encode_body for each message, or None for messages without a body
+        encode_body = cls._encode_body
+        return [None if content is None else encode_body(content)
+                for content in (message.content for message in messages)]
+
+    def _write_base64_attachment(self, sms_output, keys, content_type, order):
+        # Writes an MMS part with the downloaded file, base64 encoded a chunk at a time
+        # Attachments that were written before are reused from self.payloads
+        # Returns False if the file could not be downloaded
+        payload = self.payloads.get(*keys)
+        if payload is None:
+            with self.metrics.timer("attachment_fetch"):
+                content_hash = self.payloads.content_hash(self.downloader.result(keys[0]))
+            if content_hash is not None:
+                payload = self.payloads.get_content(content_hash, keys)
+        if payload is not None:
+            sms_output.write(MMS_PART.format(content_type, order, "base64", payload))
+            self.metrics.count("attachments_written")
+            return True
+        with self.metrics.timer("attachment_fetch"):
+            data_file = self.downloader.open(keys[0])
+        if data_file is None:
+            self.metrics.error("attachment_download", "Error downloading or base64 encoding attachment!")
+            return False
+        with data_file:
+            sms_output.write(MMS_PART_START.format(content_type, order, "base64"))
+            # Keep the encoded pieces of attachments small enough to be stored for reuse
+            pieces = []
+            size = 0
+            remainder = b""
+            while True:
+                chunk = data_file.read(BASE64_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                # Only encode multiples of 3 bytes so the chunks join up without padding
+                chunk = remainder + chunk
+                length = len(chunk) - len(chunk) % 3
+                remainder = chunk[length:]
+                piece = base64.b64encode(chunk[:length]).decode('ascii')
+                sms_output.write(piece)
+                if pieces is not None:
+                    pieces.append(piece)
+                    if size > self.payloads.max_payload_bytes:
+                        pieces = None
+            piece = base64.b64encode(remainder).decode('ascii')
+            sms_output.write(piece)
+            sms_output.write(MMS_PART_END)
+        if pieces is not None and content_hash is not None:
+            pieces.append(piece)
+            self.payloads.put(content_hash, "".join(pieces), size, keys)
+        self.metrics.count("attachments_written")
+        self.metrics.count("attachment_bytes", size)
+        return True
 
     def _create_participant_string(self, participants, self_gaia_id):
         # Builds a string containing the participants in a conversation, excluding the user
@@ -224,5 +613,107 @@ class TitaniumBackupFormatter:
     @staticmethod
     def _timestamp_to_utc_string(timestamp):
         # Converts microsecond timestamp to UTC string
+        # Uses integer arithmetic and a cached date per day; gives the same result as the datetime version
+        if type(timestamp) is not int or not 0 <= timestamp < FAST_TIMESTAMP_LIMIT:
+            return TitaniumBackupFormatter._datetime_timestamp_to_utc_string(timestamp)
+        days, microseconds = divmod(timestamp, MICROSECONDS_PER_DAY)
+        seconds, microseconds = divmod(microseconds, 1000000)
+        minutes, seconds = divmod(seconds, 60)
+        hours, minutes = divmod(minutes, 60)
+        return "%sT%02d:%02d:%02d.%03dZ" % (_utc_date_string(days), hours, minutes, seconds, microseconds // 1000)
+
+    @staticmethod
+    def _datetime_timestamp_to_utc_string(timestamp):
+        # Converts microsecond timestamp to UTC string using datetime
         (dt, microseconds) = datetime.utcfromtimestamp(timestamp / 1000000).strftime('%Y-%m-%dT%H:%M:%S.%f').split('.')
         return "%s.%03dZ" % (dt, int(microseconds) / 1000)
+
+
+class _ThreadContext:
+    # Everything needed to render the messages of a thread that does not change from message to message
+
+    def __init__(self, formatter, conversation, self_gaia_id):
+        self._formatter = formatter
+        self._participants = conversation.participants
+        self._self_gaia_id = self_gaia_id
+        self._mms_addresses = {}
+        self.address = formatter._create_participant_string(conversation.participants, self_gaia_id)
+        self.is_group = len(conversation.participants) > 2
+        # Store the other participant in the SMS conversation
+        non_self_participant = None
+        for participant in conversation.participants.values():
+            if participant.gaia_id != self_gaia_id:
+                non_self_participant = participant
+                break
+        # always assume 'locked' = false
+        # TODO: seen
+        # TODO: read
+        # address is always the number of the other person in an SMS conversation
+        self.sms_attributes = " locked=\"false\" seen=\"false\" read=\"true\" address=\"{}\"".format(
+            formatter._get_participant_phone_number(non_self_participant)
+            if non_self_participant is not None else None)
+
+    def mms_addresses(self, sender_gaia_id):
+        # Returns the addresses element of an MMS sent by a participant, rendered once per sender
+        addresses = self._mms_addresses.get(sender_gaia_id)
+        if addresses is None:
+            addresses = "<addresses>"
+            if sender_gaia_id == self._self_gaia_id:
+                addresses += "<address type=\"from\">insert-address-token</address>"
+            else:
+                sender = self._participants[sender_gaia_id]
+                addresses += "<address type=\"from\">{}</address>".format(
+                    self._formatter._get_participant_phone_number(sender))
+            # Store the other participants
+            for participant in self._participants.values():
+                if participant.gaia_id != self._self_gaia_id and participant.gaia_id != sender_gaia_id:
+                    addresses += "<address type=\"to\">{}</address>".format(
+                        self._formatter._get_participant_phone_number(participant))
+            addresses += "</addresses>"
+            self._mms_addresses[sender_gaia_id] = addresses
+        return addresses
+
+
+class _CountingIterator:
+    # Iterates over conversations, counting how many have been consumed
+    # With a known total, progress is shown as the part of the conversations consumed
+
+    def __init__(self, iterable, metrics=None, total=None):
+        self._iterator = iter(iterable)
+        self._metrics = metrics
+        self._total = total
+        self.count = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = next(self._iterator)
+        self.count += 1
+        if self._total and self._metrics is not None:
+            self._metrics.update_progress(self.count / self._total)
+        return item
+
+
+# Attachments reused and metrics kept between the threads rendered by a worker process
+_worker_payloads = None
+_worker_metrics = None
+
+
+def _render_thread(conversation, self_gaia_id, downloads):
+    # Renders the thread element for a conversation in a worker process
+    # Returns the thread and the metrics of rendering it, which the main process adds to its own
+    global _worker_payloads, _worker_metrics
+    if _worker_payloads is None:
+        _worker_payloads = AttachmentPayloads()
+        _worker_metrics = ConversionMetrics()
+        _worker_metrics.install()
+    formatter = TitaniumBackupFormatter(FetchedAttachments(downloads), payloads=_worker_payloads,
+                                        metrics=_worker_metrics)
+    output = io.BytesIO()
+    sms_output = BufferedXmlWriter(output, formatter.buffer_size)
+    formatter._write_thread(sms_output, conversation, self_gaia_id)
+    sms_output.flush()
+    state = _worker_metrics.state()
+    _worker_metrics.clear()
+    return output.getvalue(), state
@@ -0,0 +1,116 @@
+import calendar
+import json
+import xml.etree.ElementTree as ElementTree
+from datetime import datetime
+
+
+# Sender key of messages sent by the user
+SELF_SENDER = "self"
+# Address used by Titanium Backup for the user in sent MMS
+SELF_ADDRESS_TOKEN = "insert-address-token"
+
+
+class TitaniumBackupIndex:
+    """Compact index of a Titanium Backup messages XML file.
+
+    Keeps, for every thread address, the timestamp of its latest message (in milliseconds) and the senders
+    of the messages with that timestamp. That is enough to tell which messages of a newer Hangouts export
+    were not converted yet.
+    """
+
+    def __init__(self, threads=None):
+        """Create an index.
+
+        :param threads: dictionary of thread address to [latest timestamp in ms, list of sender keys]
+        """
+        self.threads = threads if threads is not None else {}
+
+    @property
+    def latest_timestamp(self):
+        """Timestamp in milliseconds of the newest message in any thread, or None if there are none."""
+        return max((latest for latest, _ in self.threads.values()), default=None)
+
+    def is_new(self, address, timestamp, sender):
+        """Return True if a message is newer than everything indexed for its thread.
+
+        :param address: address of the thread
+        :param timestamp: message timestamp in milliseconds
+        :param sender: sender key (SELF_SENDER or the phone number of the sender)
+        """
+        thread = self.threads.get(address)
+        if thread is None:
+            return True
+        latest, senders = thread
+        return timestamp > latest or (timestamp == latest and sender not in senders)
+
+    def add(self, address, timestamp, sender):
+        """Add a message to the index.
+
+        :param address: address of the thread
+        :param timestamp: message timestamp in milliseconds
+        :param sender: sender key (SELF_SENDER or the phone number of the sender)
+        """
+        thread = self.threads.get(address)
+        if thread is None or timestamp > thread[0]:
+            self.threads[address] = [timestamp, [sender]]
+        elif timestamp == thread[0] and sender not in thread[1]:
+            thread[1].append(sender)
+
+    @classmethod
+    def from_xml(cls, file_name):
+        """Build an index from a Titanium Backup messages XML file.
+
+        The file is parsed incrementally, so it can be larger than memory.
+
+        :param file_name: name of the XML file
+        :return: TitaniumBackupIndex
+        """
+        index = cls()
+        root = None
+        address = None
+        for event, element in ElementTree.iterparse(file_name, events=("start", "end")):
+            tag = element.tag.rpartition("}")[2]
+            if event == "start":
+                if root is None:
+                    root = element
+                elif tag == "thread":
+                    address = element.get("address")
+                continue
+            if tag in ("sms", "mms"):
+                date = element.get("date")
+                if date is not None and address is not None:
+                    index.add(address, utc_string_to_timestamp(date), cls._sender(tag, element))
+                element.clear()
+            elif tag == "thread":
+                # Drop finished threads from the tree
+                root.clear()
+        return index
+
+    @classmethod
+    def load(cls, file_name):
+        """Load an index saved with save()."""
+        with open(file_name, encoding="utf-8") as index_file:
+            return cls(json.load(index_file))
+
+    def save(self, file_name):
+        """Save the index as JSON."""
+        with open(file_name, "w", encoding="utf-8") as index_file:
+            json.dump(self.threads, index_file)
+
+    @staticmethod
+    def _sender(tag, element):
+        # Returns the sender key of an sms or mms element
+        if element.get("msgBox") == "sent":
+            return SELF_SENDER
+        if tag == "sms":
+            return element.get("address")
+        for address in element.iter():
+            if address.tag.rpartition("}")[2] == "address" and address.get("type") == "from":
+                return SELF_SENDER if address.text == SELF_ADDRESS_TOKEN else address.text
+        return None
+
+
+def utc_string_to_timestamp(utc_string):
+    """Convert a Titanium Backup UTC date string (e.g. 2016-01-02T03:04:05.678Z) to milliseconds."""
+    parsed = datetime.strptime(utc_string, "%Y-%m-%dT%H:%M:%S.%fZ")
+    return calendar.timegm(parsed.timetuple()) * 1000 + parsed.microsecond // 1000
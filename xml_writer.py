@@ -0,0 +1,283 @@
+import glob
+import os
+import re
+import time
+
+
+# End tags of the messages in a rendered thread; they cannot occur inside escaped or base64 content
+MESSAGE_END = re.compile(rb"</sms>|</mms>")
+THREAD_END = b"</thread>"
+
+
+class BufferedXmlWriter:
+    """Buffered UTF-8 writer for XML output.
+
+    Text fragments are collected in a list and written to the underlying binary file in large blocks,
+    encoded to UTF-8 once per block, instead of encoding and writing every fragment separately.
+
+    write() tracks the size of what it buffers and suits fragments of any size. append() is a cheaper path
+    for the many short fragments of a message: it only adds to the list, and callers call check() after
+    each batch (e.g. each message), which writes out the buffer once enough fragments have been collected.
+    """
+    BUFFER_SIZE = 1024 * 1024
+    # Assumed average length of appended fragments, used to turn buffer_size into a number of fragments
+    FRAGMENT_SIZE = 32
+
+    def __init__(self, output_file, buffer_size=BUFFER_SIZE, metrics=None):
+        """Create a writer.
+
+        :param output_file: binary file object to write to
+        :param buffer_size: number of characters collected before they are written out
+        :param metrics: optional ConversionMetrics the time spent writing to the file is added to
+        """
+        self.output_file = output_file
+        self.metrics = metrics
+        self.buffer_size = buffer_size
+        self.bytes_written = 0
+        self._fragments = []
+        self._buffered = 0
+        self._fragment_limit = max(1, buffer_size // self.FRAGMENT_SIZE)
+        self.append = self._fragments.append
+
+    def write(self, text):
+        """Add a text fragment to the output."""
+        self._fragments.append(text)
+        self._buffered += len(text)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def check(self):
+        """Write out the buffer if enough fragments have been appended."""
+        if len(self._fragments) >= self._fragment_limit:
+            self.flush()
+
+    def write_bytes(self, data):
+        """Add already UTF-8 encoded data to the output."""
+        self.flush()
+        self._write(data)
+
+    def flush(self):
+        """Write out all buffered fragments."""
+        if self._fragments:
+            data = "".join(self._fragments).encode("utf-8")
+            self._fragments.clear()
+            self._buffered = 0
+            self._write(data)
+
+    def tell(self):
+        """Return the current position in the underlying file."""
+        self.flush()
+        return self.output_file.tell()
+
+    def seek(self, position):
+        """Write out buffered fragments and move to a position in the underlying file."""
+        self.flush()
+        self.output_file.seek(position)
+
+    def start_thread(self, address):
+        """Write the start tag of a thread element."""
+        self.write("<thread address=\"{}\">".format(address))
+
+    def end_thread(self):
+        """Write the end tag of a thread element."""
+        self.write("</thread>")
+
+    def start_message(self):
+        """Announce that the fragments of a message of the open thread are about to be appended."""
+
+    def write_rendered_thread(self, chunks):
+        """Write a complete thread element that has already been rendered and UTF-8 encoded.
+
+        :param chunks: iterable of bytes that together make up the thread element
+        """
+        for chunk in chunks:
+            self.write_bytes(chunk)
+
+    def _write(self, data):
+        # Writes encoded data to the file
+        if self.metrics is None:
+            self.output_file.write(data)
+        else:
+            start = time.perf_counter()
+            self.output_file.write(data)
+            self.metrics.add_time("write", time.perf_counter() - start)
+        self.bytes_written += len(data)
+
+
+class ShardedXmlWriter(BufferedXmlWriter):
+    """BufferedXmlWriter that spreads the output over several files of bounded size.
+
+    Once a file reaches the byte or message budget, the next message of the open thread closes the thread
+    and the file and continues in the next file, reopening the thread there. A thread that ends right at
+    the budget is not reopened; the next thread starts the next file instead. Files only end between
+    messages, so a file can exceed the byte budget by one message. Threads that were rendered beforehand
+    (by worker processes or into a checkpoint) are split the same way as they are copied in with
+    write_rendered_thread(). Every file gets its own header with the number of threads in it.
+
+    The files are named after the output file with a number added, e.g. messages-001.xml. Numbered files
+    left by an earlier conversion are deleted first, so none of them is mistaken for part of the new output.
+    """
+
+    def __init__(self, file_name, header, footer, max_bytes=None, max_messages=None,
+                 buffer_size=BufferedXmlWriter.BUFFER_SIZE, metrics=None):
+        """Create a writer and open the first file.
+
+        :param file_name: name of the output file the numbered file names are derived from
+        :param header: function returning the header of a file for its thread count; its length must not
+                       depend on the count, so it can be written over the placeholder of a finished file
+        :param footer: text written at the end of every file
+        :param max_bytes: optional maximum size of a file in bytes
+        :param max_messages: optional maximum number of messages in a file
+        :param buffer_size: number of characters collected before they are written out
+        :param metrics: optional ConversionMetrics the time spent writing to the files is added to
+        """
+        super().__init__(None, buffer_size, metrics)
+        self.file_name = file_name
+        self.header = header
+        self.footer = footer
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.file_names = []
+        self._address = None  # Address of the open thread, None between threads
+        self._full = False  # The current file reached a budget; set by check()
+        self._thread_count = 0
+        self._message_count = 0
+        self._file_start = 0
+        self._measured_fragments = 0
+        self._measured_size = 0
+        self._remove_old_files()
+        self._open_file()
+
+    def check(self):
+        """Write out the buffer if enough fragments have been appended, and end the file if it is full.
+
+        Called after every message.
+        """
+        self._message_count += 1
+        super().check()
+        self._full = self._is_full()
+
+    def start_message(self):
+        """Announce the next message of the open thread, continuing the thread in a new file if this one is full."""
+        if self._full and self._address is not None:
+            address = self._address
+            self.end_thread()
+            self._next_file()
+            self.start_thread(address)
+
+    def flush(self):
+        """Write out all buffered fragments."""
+        super().flush()
+        self._measured_fragments = 0
+        self._measured_size = 0
+
+    def start_thread(self, address):
+        """Write the start tag of a thread element, in a new file if the current one is full."""
+        if self._thread_count > 0 and self._is_full():
+            self._next_file()
+        self._address = address
+        self._thread_count += 1
+        super().start_thread(address)
+
+    def end_thread(self):
+        """Write the end tag of a thread element."""
+        super().end_thread()
+        self._address = None
+
+    def write_rendered_thread(self, chunks):
+        """Write a complete, already rendered thread element, splitting it between messages when a file is full.
+
+        :param chunks: iterable of bytes that together make up the thread element
+        """
+        buffer = b""
+        start_tag = None
+        split = False  # The file is full after a message; the next message of the thread goes to a new file
+        chunks = iter(chunks)
+        end_of_thread = False
+        while not end_of_thread:
+            chunk = next(chunks, None)
+            if chunk is None:
+                end_of_thread = True
+            else:
+                buffer += chunk
+            if start_tag is None:
+                tag_end = buffer.find(b">")
+                if tag_end < 0:
+                    continue
+                start_tag = buffer[:tag_end + 1]
+                buffer = buffer[tag_end + 1:]
+                if self._thread_count > 0 and self._is_full():
+                    self._next_file()
+                self._thread_count += 1
+                self.write_bytes(start_tag)
+            while True:
+                if split:
+                    # Wait until it is known whether another message follows or the thread ends
+                    if len(buffer) < len(THREAD_END) and not end_of_thread:
+                        break
+                    if not buffer.startswith(THREAD_END):
+                        self.write_bytes(THREAD_END)
+                        self._next_file()
+                        self._thread_count += 1
+                        self.write_bytes(start_tag)
+                    split = False
+                match = MESSAGE_END.search(buffer)
+                if match is None:
+                    # Hold back what may be the start of an end tag
+                    keep = len(buffer) if end_of_thread else max(len(buffer) - len(THREAD_END), 0)
+                    self.write_bytes(buffer[:keep])
+                    buffer = buffer[keep:]
+                    break
+                self.write_bytes(buffer[:match.end()])
+                buffer = buffer[match.end():]
+                self._message_count += 1
+                split = self._is_full()
+
+    def close(self):
+        """Finish the last file."""
+        self._close_file()
+
+    def _is_full(self):
+        # Returns True once the current file has reached a budget
+        if self.max_messages is not None and self._message_count >= self.max_messages:
+            return True
+        if self.max_bytes is None:
+            return False
+        # Only the fragments appended since the last measurement are measured
+        fragments = self._fragments
+        if self._measured_fragments < len(fragments):
+            self._measured_size += sum(map(len, fragments[self._measured_fragments:]))
+            self._measured_fragments = len(fragments)
+        return self.bytes_written - self._file_start + self._measured_size + len(self.footer) >= self.max_bytes
+
+    def _remove_old_files(self):
+        # Deletes the numbered files of an earlier conversion to the same output file
+        root, extension = os.path.splitext(self.file_name)
+        numbered = re.compile(re.escape(root) + r"-\d{3,}" + re.escape(extension) + "$")
+        for file_name in glob.glob(glob.escape(root) + "-[0-9][0-9][0-9]*" + glob.escape(extension)):
+            if numbered.match(file_name):
+                os.remove(file_name)
+
+    def _open_file(self):
+        # Starts the next numbered file with a placeholder header
+        root, extension = os.path.splitext(self.file_name)
+        file_name = "{}-{:03d}{}".format(root, len(self.file_names) + 1, extension)
+        self.output_file = open(file_name, "wb")
+        self.file_names.append(file_name)
+        self._file_start = self.bytes_written
+        self._thread_count = 0
+        self._message_count = 0
+        self._full = False
+        self.write(self.header(0))
+
+    def _close_file(self):
+        # Ends the current file and writes its real thread count over the placeholder
+        self.write(self.footer)
+        self.flush()
+        self.output_file.seek(0)
+        self.output_file.write(self.header(self._thread_count).encode("utf-8"))
+        self.output_file.close()
+
+    def _next_file(self):
+        self._close_file()
+        self._open_file()